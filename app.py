@@ -1,14 +1,31 @@
+import atexit
 import base64
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
 from functools import wraps
 
 from firebase_admin import auth
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 
-from file_utils import extract_text_and_chunks, DependencyError
+from chunking import create_chunker
+from file_utils import stream_text_and_chunks, DependencyError
+from services.create_deck_and_card import CreateDeckAndCard
 from services.firebase_client import Firebase
-from services.llm import generate_flashcards
+from services.flashcard_cache import FlashcardCache
+from services.jobs import JobQueue, JobStatus
+from services.library_cache import library_cache
+from services.library_version import library_versions
+from services.llm import LLM_MODEL, generate_flashcards_concurrently, chunk_memo_stats, llm_resilience_stats
+from services.persistence import WriteBehindPersister
+from services.rate_limiter import rate_limiter
 from services.sync import SyncService, SyncData
 
 # Configure logging
@@ -19,6 +36,31 @@ logger = logging.getLogger(__name__)
 db = Firebase.init_db()
 app = Flask(__name__)
 
+# 'structured' packs paragraphs up to the model's token budget, 'words' sends fixed word slices
+CHUNKER = os.environ.get('CHUNKER', 'structured')
+# Number of words per chunk sent to the LLM by the 'words' chunker
+CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE', 1000))
+chunker = create_chunker(CHUNKER, CHUNK_SIZE, LLM_MODEL)
+flashcard_cache = FlashcardCache()
+
+# Generated decks are written to Firestore in the background, and before the process exits.
+# Fly stops machines with SIGINT which ends the server normally, SIGTERM is made to do the same
+persister = WriteBehindPersister(db)
+atexit.register(persister.drain)
+if multiprocessing.parent_process() is None and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+# Content types accepted as a raw request body upload
+RAW_UPLOAD_TYPES = ("application/pdf", "image/png", "image/jpeg", "image/gif")
+# Directory for spooled uploads, defaults to the system temp dir
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR') or None
+
+# Accept header values that switch /generate_flashcards to a streamed response
+STREAM_FORMATS = {
+    "application/x-ndjson": "ndjson",
+    "text/event-stream": "sse"
+}
+
 
 class APIResponse:
     """Standardized API response structure"""
@@ -41,58 +83,317 @@ class APIResponse:
         }, status_code
 
 
+def get_request_data():
+    """Fields of a JSON or multipart/form-data body, raw uploads carry none"""
+    if request.is_json:
+        return request.get_json()
+    if request.mimetype == "multipart/form-data":
+        return request.form.to_dict()
+    return {}
+
+
+def get_bearer_token():
+    """Token from an 'Authorization: Bearer TOKEN' header, if any"""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+
 def require_auth(f):
-    """Decorator to handle authentication for protected routes"""
+    """
+    Decorator to handle authentication for protected routes
+
+    Prefers an 'Authorization: Bearer TOKEN' header and falls back to the
+    login_token/token body field used by older clients.
+    """
     @wraps(f)
     def decorated_function(*args, **kwargs):
         try:
-            data = request.get_json()
+            # Header tokens are verified before the body is read, so rejected
+            # requests never buffer or decode the upload
+            bearer_token = get_bearer_token()
+            if bearer_token:
+                user_id = Firebase.verify_token(bearer_token)
+                if not user_id:
+                    return APIResponse.error("Invalid authentication token", "unauthorized", 401)
+                return f(user_id, get_request_data(), *args, **kwargs)
+
+            # Older clients send the token inside the body
+            data = get_request_data()
             if not data:
-                return jsonify(*APIResponse.error("Missing request body"))
+                return APIResponse.error("Missing request body")
 
             token = data.get("login_token") or data.get("token")
             if not token:
-                return jsonify(*APIResponse.error("Missing authentication token", "unauthorized", 401))
+                return APIResponse.error("Missing authentication token", "unauthorized", 401)
 
             user_id = Firebase.verify_token(token)
             if not user_id:
-                return jsonify(*APIResponse.error("Invalid authentication token", "unauthorized", 401))
+                return APIResponse.error("Invalid authentication token", "unauthorized", 401)
 
             # Pass user_id and data to the decorated function
             return f(user_id, data, *args, **kwargs)
 
         except auth.ExpiredIdTokenError:
-            return jsonify(*APIResponse.error("Authentication token expired", "expired", 401))
+            return APIResponse.error("Authentication token expired", "expired", 401)
         except auth.InvalidIdTokenError:
-            return jsonify(*APIResponse.error("Invalid authentication token", "invalid_token", 401))
+            return APIResponse.error("Invalid authentication token", "invalid_token", 401)
         except Exception as e:
             logger.error(f"Authentication error: {str(e)}")
-            return jsonify(*APIResponse.error("Authentication failed", "auth_error", 401))
+            return APIResponse.error("Authentication failed", "auth_error", 401)
 
     return decorated_function
 
 
-def process_file_chunks(file_bytes):
-    """Extract text chunks from file and generate flashcards"""
+def build_cards(user_id, deck, cards):
+    """Card documents of the deck for generated {front, back} cards"""
+    writer = CreateDeckAndCard(db, user_id)
+    return [writer.build_card(deck["id"], card["front"], card["back"]) for card in cards]
+
+
+def process_file_chunks(file_source):
+    """
+    Extract text chunks from file and generate flashcards
+
+    Chunks are sent to the LLM concurrently. Returns the cards in chunk order
+    together with the indexes of chunks that failed, a failing chunk only
+    drops its own cards unless every chunk failed. Files that were fully
+    processed before are served from the flashcard cache.
+    """
     try:
-        logger.info("Extracting text and chunks from file")
-        text_chunks = extract_text_and_chunks(file_bytes)
-        logger.info(f"Extracted {len(text_chunks)} chunks")
+        cache_key = flashcard_cache.make_key(file_source, chunker.signature)
+        cached_cards = flashcard_cache.get(cache_key)
+        if cached_cards is not None:
+            return cached_cards, []
+
+        # Chunks are sent to the LLM while later pages are still being extracted
+        text_chunks = stream_text_and_chunks(file_source, chunker=chunker)
+        results = sorted(generate_flashcards_concurrently(text_chunks), key=lambda result: result.index)
+        logger.info(f"Processed {len(results)} chunks")
+        failed = [result for result in results if result.error]
+        if results and len(failed) == len(results):
+            raise failed[0].error
+        cacheable = all(result.cacheable for result in results)
 
         cards = []
-        for i, chunk in enumerate(text_chunks):
-            logger.info(f"Processing chunk {i+1}/{len(text_chunks)}")
-            chunk_cards = generate_flashcards(chunk)
-            if chunk_cards:
-                # Convert Flashcard objects to dictionaries for JSON serialization
-                cards.extend([card.to_dict() for card in chunk_cards])
-
-        return cards
+        for result in results:
+            # Convert Flashcard objects to dictionaries for JSON serialization
+            cards.extend([card.to_dict() for card in result.flashcards])
+
+        if failed:
+            logger.warning(f"{len(failed)}/{len(results)} chunks failed to generate flashcards")
+        elif cards and cacheable:
+            # Only complete results of the primary model are cached, other chunks get retried on re-upload
+            flashcard_cache.set(cache_key, cards)
+
+        return cards, [result.index for result in failed]
     except Exception as e:
         logger.error(f"Error processing file chunks: {str(e)}")
         raise
 
 
+def get_stream_format(data):
+    """Return 'ndjson' or 'sse' when the client asked for a streamed response, else None"""
+    requested = data.get("stream")
+    if requested in STREAM_FORMATS.values():
+        return requested
+    for mimetype, _ in request.accept_mimetypes:
+        if mimetype in STREAM_FORMATS:
+            return STREAM_FORMATS[mimetype]
+    return None
+
+
+def format_stream_frame(frame, stream_format):
+    """Serialize a single frame as an NDJSON line or a Server-Sent Event"""
+    payload = json.dumps(frame)
+    if stream_format == "sse":
+        return f"event: {frame['type']}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+
+def stream_file_chunks(file_source, file_name, user_id, stream_format):
+    """
+    Stream flashcards to the client as each chunk completes
+
+    Emits 'cards' frames tagged with their chunk index as soon as the cards
+    are parsed from the LLM response, so a chunk may send several, in
+    completion order, an 'error' frame per failed chunk and a final
+    'summary' frame, preceded by a 'deck' frame with the deck the cards are
+    saved to. The file is opened before the response starts so invalid files
+    still get a regular error response, pages are then extracted while
+    earlier chunks are being generated. Cards are not accumulated, so
+    streamed results only populate the per-chunk memo, each chunk's cards
+    are handed to the persister as soon as they are sent.
+    """
+    cached_cards = flashcard_cache.get(flashcard_cache.make_key(file_source, chunker.signature))
+    text_chunks = None
+    if cached_cards is None:
+        text_chunks = stream_text_and_chunks(file_source, chunker=chunker)
+
+    deck = CreateDeckAndCard(db, user_id).build_deck(file_name)
+
+    def generate():
+        yield format_stream_frame({"type": "deck", "deck": deck}, stream_format)
+        if cached_cards is not None:
+            cards = build_cards(user_id, deck, cached_cards)
+            persister.submit(user_id, deck, cards)
+            yield format_stream_frame({"type": "cards", "chunk": None, "cards": cards}, stream_format)
+            yield format_stream_frame({
+                "type": "summary", "total_cards": len(cached_cards), "chunks": None, "failed_chunks": [], "cached": True
+            }, stream_format)
+            return
+
+        total_cards = 0
+        total_chunks = 0
+        failed_chunks = []
+        deck_submitted = False
+        # Cards already sent for chunks still streaming, persisted together once the chunk is done
+        unsaved_cards = {}
+        try:
+            for result in generate_flashcards_concurrently(text_chunks, partial=True):
+                if not result.partial:
+                    total_chunks += 1
+                if result.error:
+                    if unsaved_cards.get(result.index):
+                        # Cards the client already has are kept, like those of a stream that broke off
+                        persister.submit(user_id, None if deck_submitted else deck, unsaved_cards.pop(result.index))
+                        deck_submitted = True
+                    failed_chunks.append(result.index)
+                    yield format_stream_frame({
+                        "type": "error", "chunk": result.index, "message": "Failed to generate flashcards for chunk"
+                    }, stream_format)
+                    continue
+                cards = build_cards(user_id, deck, [card.to_dict() for card in result.flashcards])
+                total_cards += len(cards)
+                chunk_cards = unsaved_cards.pop(result.index, []) + cards
+                if result.partial:
+                    unsaved_cards[result.index] = chunk_cards
+                elif chunk_cards:
+                    # Only the first submission carries the deck, later ones add cards to it
+                    persister.submit(user_id, None if deck_submitted else deck, chunk_cards)
+                    deck_submitted = True
+                if cards:
+                    yield format_stream_frame({"type": "cards", "chunk": result.index, "cards": cards}, stream_format)
+        except Exception as e:
+            logger.error(f"Error streaming flashcards: {str(e)}")
+            yield format_stream_frame({"type": "error", "chunk": None, "message": "Failed to process file"}, stream_format)
+
+        logger.info(f"Streamed {total_cards} flashcards from file '{file_name}' for user {user_id}")
+        yield format_stream_frame({
+            "type": "summary",
+            "total_cards": total_cards,
+            "chunks": total_chunks,
+            "failed_chunks": sorted(failed_chunks),
+            "cached": False
+        }, stream_format)
+
+    mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def run_generation_job(file_source, progress):
+    """
+    Job queue handler, records the cards of every chunk as it completes
+
+    The deck and the cards of all successful chunks are handed to the
+    persister once the job is done.
+    """
+    deck = CreateDeckAndCard(db, progress.user_id).build_deck(progress.file_name)
+    cache_key = flashcard_cache.make_key(file_source, chunker.signature)
+    cached_cards = flashcard_cache.get(cache_key)
+    if cached_cards is not None:
+        cards = build_cards(progress.user_id, deck, cached_cards)
+        progress.set_total(1)
+        progress.chunk_done(0, cards)
+        persister.submit(progress.user_id, deck, cards)
+        return
+
+    # The total is only known once extraction finishes, it is set afterwards
+    chunk_cards = {}
+    total_chunks = 0
+    cacheable = True
+    for result in generate_flashcards_concurrently(stream_text_and_chunks(file_source, chunker=chunker)):
+        total_chunks += 1
+        cacheable = cacheable and result.cacheable
+        cards = build_cards(progress.user_id, deck, [card.to_dict() for card in result.flashcards])
+        progress.chunk_done(result.index, cards, "Failed to generate flashcards for chunk" if result.error else None)
+        if not result.error:
+            chunk_cards[result.index] = cards
+
+    progress.set_total(total_chunks)
+
+    cards = [card for index in sorted(chunk_cards) for card in chunk_cards[index]]
+    if cards:
+        persister.submit(progress.user_id, deck, cards)
+    if cards and len(chunk_cards) == total_chunks and cacheable:
+        # The cache keeps plain {front, back} cards, ids are assigned per upload
+        flashcard_cache.set(cache_key, [{"front": card["front"], "back": card["back"]} for card in cards])
+
+
+job_queue = JobQueue(run_generation_job)
+
+
+@app.before_request
+def start_background_workers():
+    """
+    Start the job and persistence workers in the process that serves requests. Not at
+    import: the debug reloader's watcher and the spawned OCR workers import this module too
+    """
+    job_queue.start()
+    persister.start()
+
+
+def spool_upload(stream):
+    """Copy an upload stream to a temp file that is removed when the request ends"""
+    spool = tempfile.NamedTemporaryFile(delete=False, dir=UPLOAD_SPOOL_DIR, suffix=".upload")
+    with spool:
+        shutil.copyfileobj(stream, spool, 1024 * 1024)
+    g.setdefault("spooled_uploads", []).append(spool.name)
+    return spool.name
+
+
+def get_uploaded_file(data):
+    """
+    Return (file_source, file_name) for any supported upload
+
+    multipart/form-data: 'file' part, spooled to disk
+    raw application/pdf or image body: name in the X-File-Name header or
+    the file_name query parameter, spooled to disk
+    JSON: base64 encoded 'file' field, decoded in memory
+    """
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        if not upload:
+            raise ValueError("Missing file data")
+        file_name = data.get("file_name") or upload.filename
+        if not file_name:
+            raise ValueError("Missing file name")
+        return spool_upload(upload.stream), file_name
+
+    if request.mimetype in RAW_UPLOAD_TYPES:
+        file_name = request.headers.get("X-File-Name") or request.args.get("file_name")
+        if not file_name:
+            raise ValueError("Missing file name")
+        return spool_upload(request.stream), file_name
+
+    return validate_file_data(data)
+
+
+@app.teardown_request
+def remove_spooled_uploads(error=None):
+    """Delete temp files created by spool_upload, after streamed responses finish"""
+    for path in g.pop("spooled_uploads", []):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
 def validate_file_data(data):
     """Validate file-related data from request"""
     file_b64 = data.get('file')
@@ -116,47 +417,143 @@ def home():
     return jsonify(APIResponse.success({"status": "running", "service": "study-io-backend"}))
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Cache and performance counters"""
+    return jsonify(APIResponse.success({
+        "flashcard_cache": flashcard_cache.stats(),
+        "chunk_memo": chunk_memo_stats(),
+        "token_cache": Firebase.token_cache_stats(),
+        "library_versions": library_versions.stats(),
+        "library_cache": library_cache.stats(),
+        "persistence": persister.stats(),
+        "llm_rate_limiter": rate_limiter.stats(),
+        "llm_models": llm_resilience_stats()
+    }))
+
+
 @app.route('/generate_flashcards', methods=['POST'])
 @require_auth
 def generate_flashcards_endpoint(user_id, data):
     """
     Generate flashcards from uploaded file
 
-    Expected JSON structure:
+    The file can be sent as multipart/form-data (fields: file, file_name,
+    login_token), as a raw application/pdf or image body with the token in
+    an 'Authorization: Bearer' header, or base64 encoded in JSON:
     {
         "login_token": "TOKEN",
         "file_name": "FILE_NAME",
         "file": "BASE64_ENCODED_FILE",
+        "stream": "ndjson" | "sse" (optional)
     }
+
+    Streaming can also be requested with an 'Accept: application/x-ndjson'
+    or 'Accept: text/event-stream' header.
+
+    The generated deck and cards are returned with their ids and saved in
+    the background, they show up in the user's next /sync.
     """
     try:
         # Validate file data
-        file_bytes, file_name = validate_file_data(data)
+        file_source, file_name = get_uploaded_file(data)
+
+        stream_format = get_stream_format(data)
+        if stream_format:
+            return stream_file_chunks(file_source, file_name, user_id, stream_format)
 
         # Process file and generate cards
-        cards = process_file_chunks(file_bytes)
+        cards, failed_chunks = process_file_chunks(file_source)
 
         if not cards:
-            return jsonify(*APIResponse.error("No flashcards could be generated from the file"))
+            return APIResponse.error("No flashcards could be generated from the file")
 
         logger.info(f"Generated {len(cards)} flashcards from file '{file_name}' for user {user_id}")
 
-        cards = {"cards": cards}
-        print(cards)
-        return jsonify(APIResponse.success(cards, "Flashcards generated successfully"))
+        # Saved in the background, the deck shows up in the user's next sync
+        deck = CreateDeckAndCard(db, user_id).build_deck(file_name)
+        cards = build_cards(user_id, deck, cards)
+        persister.submit(user_id, deck, cards)
+
+        response = {"deck": deck, "cards": cards}
+        if failed_chunks:
+            response["failed_chunks"] = failed_chunks
+        return jsonify(APIResponse.success(response, "Flashcards generated successfully"))
 
     except ValueError as e:
-        return jsonify(*APIResponse.error(str(e), "validation_error", 400))
+        return APIResponse.error(str(e), "validation_error", 400)
     except DependencyError as e:
         logger.error(f"Dependency error: {str(e)}")
-        return jsonify(*APIResponse.error(
+        return APIResponse.error(
             f"Missing system dependency: {str(e)}. Please contact support.",
             "dependency_error",
             500
-        ))
+        )
     except Exception as e:
         logger.error(f"Error generating flashcards: {str(e)}")
-        return jsonify(*APIResponse.error("Failed to process file", "processing_error", 500))
+        return APIResponse.error("Failed to process file", "processing_error", 500)
+
+
+@app.route('/jobs', methods=['POST'])
+@require_auth
+def submit_job_endpoint(user_id, data):
+    """
+    Queue flashcard generation and return immediately with a job id
+
+    Accepts the same upload formats as /generate_flashcards
+    """
+    try:
+        file_source, file_name = get_uploaded_file(data)
+        job_id = job_queue.submit(user_id, file_name, file_source)
+        return jsonify(APIResponse.success(
+            {"job_id": job_id, "status": JobStatus.QUEUED.value}, "Job queued"
+        )), 202
+    except ValueError as e:
+        return APIResponse.error(str(e), "validation_error", 400)
+    except Exception as e:
+        logger.error(f"Error queueing job: {str(e)}")
+        return APIResponse.error("Failed to queue job", "job_error", 500)
+
+
+@app.route('/jobs/<job_id>', methods=['GET', 'POST'])
+@require_auth
+def job_status_endpoint(user_id, data, job_id):
+    """
+    Progress and per-chunk results of a job
+
+    Send 'Accept: text/event-stream' to subscribe to progress events until
+    the job finishes instead of polling.
+    """
+    job = job_queue.get(job_id, user_id)
+    if not job:
+        return APIResponse.error("Job not found", "not_found", 404)
+
+    if get_stream_format(data) != "sse":
+        return jsonify(APIResponse.success(job))
+
+    def generate():
+        sent_chunks = set()
+        last_status = None
+        current = job
+        while current:
+            new_chunks = [chunk for chunk in current["chunks"] if chunk["index"] not in sent_chunks]
+            for chunk in new_chunks:
+                sent_chunks.add(chunk["index"])
+                yield format_stream_frame({"type": "chunk", **chunk}, "sse")
+            if new_chunks or current["status"] != last_status:
+                progress = {key: value for key, value in current.items() if key != "chunks"}
+                yield format_stream_frame({"type": "progress", **progress}, "sse")
+            if current["status"] in (JobStatus.COMPLETED.value, JobStatus.FAILED.value):
+                return
+            last_status = current["status"]
+            time.sleep(1)
+            current = job_queue.get(job_id, user_id)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.route('/sync', methods=['POST'])
@@ -169,44 +566,70 @@ def sync_endpoint(user_id, data):
     {
         "token": "TOKEN",
         "decks": [...],
-        "cards": [...]
+        "cards": [...],
+        "deleted_decks": ["DECK_ID", ...] (optional),
+        "deleted_cards": [{"id": "CARD_ID", "deckId": "DECK_ID"}, ...] (optional),
+        "sync_token": "TOKEN_FROM_LAST_SYNC" (optional),
+        "library_version": "VERSION_FROM_LAST_SYNC" (optional)
     }
+
+    With a sync_token only the changes since that sync are returned
+    (is_delta is true), otherwise the whole library. The response's
+    sync_token is sent with the next sync, and write_results lists the
+    client's decks and cards that could not be written.
+
+    The library version can also be sent as an If-None-Match header. When it
+    is current and the client sends no changes the response only has
+    not_modified set, without reading Firestore.
     """
     try:
         # Extract sync data
         sync_data = SyncData(
             decks=data.get("decks", []),
-            cards=data.get("cards", [])
+            cards=data.get("cards", []),
+            deleted_decks=data.get("deleted_decks", []),
+            deleted_cards=data.get("deleted_cards", []),
+            sync_token=data.get("sync_token"),
+            library_version=data.get("library_version") or request.headers.get("If-None-Match", "").strip('"') or None
         )
 
         # Perform sync
         sync_service = SyncService(db)
         new_sync_data = sync_service.sync_data(user_id, sync_data)
 
-        return jsonify(new_sync_data), 200
+        if new_sync_data.not_modified:
+            response = jsonify({
+                "not_modified": True,
+                "library_version": new_sync_data.library_version,
+                "sync_token": new_sync_data.sync_token
+            })
+        else:
+            response = jsonify(new_sync_data)
+        response.set_etag(new_sync_data.library_version)
+        return response, 200
     
     except Exception as e:
         logger.error(f"Error syncing data for user {user_id}: {str(e)}")
-        return jsonify(*APIResponse.error("Failed to sync data", "sync_error", 500))
+        return APIResponse.error("Failed to sync data", "sync_error", 500)
 
 
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors"""
-    return jsonify(*APIResponse.error("Endpoint not found", "not_found", 404))
+    return APIResponse.error("Endpoint not found", "not_found", 404)
 
 
 @app.errorhandler(405)
 def method_not_allowed(error):
     """Handle 405 errors"""
-    return jsonify(*APIResponse.error("Method not allowed", "method_not_allowed", 405))
+    return APIResponse.error("Method not allowed", "method_not_allowed", 405)
 
 
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 errors"""
     logger.error(f"Internal server error: {str(error)}")
-    return jsonify(*APIResponse.error("Internal server error", "internal_error", 500))
+    return APIResponse.error("Internal server error", "internal_error", 500)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+LLM Client Benchmark
+Measures flashcard generation throughput against a local stub of the OpenRouter
+chat completions API, so no API key or network access is needed.
+
+The stub answers every request after BENCH_LLM_LATENCY seconds with a fixed list of
+flashcards, streamed or not depending on LLM_STREAMING. It is plugged in with
+set_llm_client, set BENCH_LLM_API_BASE to benchmark a real OpenAI compatible server
+(with OPENROUTER_API_KEY) instead.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK_COUNT = int(os.getenv("BENCH_LLM_CHUNKS", "64"))
+CONCURRENCY = [int(n) for n in os.getenv("BENCH_LLM_CONCURRENCY", "1,4,16").split(",")]
+LATENCY = float(os.getenv("BENCH_LLM_LATENCY", "0.2"))
+
+STUB_CARDS = json.dumps([{"front": f"Question {i}", "back": f"Answer {i}"} for i in range(5)])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers POST /chat/completions like OpenRouter, streamed when asked to"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        time.sleep(LATENCY)
+        if not request.get("stream"):
+            body = json.dumps({"choices": [{"message": {"role": "assistant", "content": STUB_CARDS}}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [STUB_CARDS[i:i + 40] for i in range(0, len(STUB_CARDS), 40)]
+        for piece in pieces:
+            self.write_chunk(f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]})}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.write_chunk("")
+
+    def write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    """Serve the stub on a free local port, returns its base URL"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/api/v1"
+
+
+def main():
+    print("LLM Client Benchmark")
+    print("=" * 40)
+
+    # Every chunk is sent, neither the memo nor the rate limiter may hide the client
+    os.environ.setdefault("CHUNK_MEMO_BACKEND", "memory")
+    os.environ.setdefault("LLM_PACKING", "false")
+    os.environ.setdefault("LLM_RATE_LIMIT", "1000")
+    os.environ.setdefault("LLM_RATE_LIMIT_MAX", "1000")
+    os.environ.setdefault("LLM_RATE_BURST", "1000")
+
+    from services.llm import LLM_STREAMING, LLMClient, generate_flashcards_concurrently, set_llm_client
+
+    base_url = os.getenv("BENCH_LLM_API_BASE") or start_stub_server()
+    set_llm_client(LLMClient(base_url, api_key=os.getenv("OPENROUTER_API_KEY")))
+
+    print(f"Endpoint: {base_url}, streaming: {LLM_STREAMING}, {CHUNK_COUNT} chunks")
+    print(f"{'workers':>8} {'seconds':>8} {'chunks/s':>9} {'cards':>6} {'failed':>7}")
+    for run, workers in enumerate(CONCURRENCY):
+        chunks = (f"Benchmark run {run} chunk {i}" for i in range(CHUNK_COUNT))
+        start = time.perf_counter()
+        results = list(generate_flashcards_concurrently(chunks, max_workers=workers))
+        seconds = time.perf_counter() - start
+        cards = sum(len(result.flashcards) for result in results)
+        failed = sum(1 for result in results if result.error)
+        print(f"{workers:>8} {seconds:>8.2f} {CHUNK_COUNT / seconds:>9.1f} {cards:>6} {failed:>7}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"Benchmark failed: {e}")
+        sys.exit(1)
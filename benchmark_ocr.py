@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+OCR Preprocessing Benchmark
+Compares OCR time and accuracy of every preprocessing preset in ocr_utils on sample images.
+
+Sample images are taken from BENCH_OCR_IMAGES (comma separated paths) or test_files.
+Accuracy is measured against a <image name>.txt transcript next to the image when
+there is one, otherwise against the text OCRed without preprocessing.
+"""
+
+import difflib
+import os
+import sys
+import time
+from glob import glob
+
+import pytesseract
+from PIL import Image
+
+from file_utils import IMAGE_OCR_CONFIG, check_tesseract_installation
+from ocr_utils import OCR_PRESETS, preprocess_image
+
+IMAGE_PATTERNS = ("*.png", "*.jpg", "*.jpeg", "*.gif")
+RUNS = int(os.getenv("BENCH_RUNS", "1"))
+
+
+def sample_images():
+    """Paths of the images to benchmark"""
+    if os.getenv("BENCH_OCR_IMAGES"):
+        return [path.strip() for path in os.getenv("BENCH_OCR_IMAGES").split(",") if path.strip()]
+    return sorted(path for pattern in IMAGE_PATTERNS for path in glob(os.path.join("test_files", pattern)))
+
+
+def word_accuracy(text, reference):
+    """Share of the reference words recovered in order, 1.0 is a perfect match"""
+    reference_words = reference.lower().split()
+    if not reference_words:
+        return 1.0 if not text.split() else 0.0
+    matcher = difflib.SequenceMatcher(None, reference_words, text.lower().split(), autojunk=False)
+    return sum(block.size for block in matcher.get_matching_blocks()) / len(reference_words)
+
+
+def run_preset(path, preset):
+    """Best of RUNS (preprocess seconds, OCR seconds) and the OCRed text"""
+    best = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        image = preprocess_image(Image.open(path), preset)
+        preprocessed = time.perf_counter()
+        text = pytesseract.image_to_string(image, config=IMAGE_OCR_CONFIG)
+        timings = (preprocessed - start, time.perf_counter() - preprocessed)
+        if best is None or sum(timings) < sum(best[0]):
+            best = (timings, text, image.size)
+    return best
+
+
+def main():
+    print("OCR Preprocessing Benchmark")
+    print("=" * 40)
+    check_tesseract_installation()
+
+    images = sample_images()
+    if not images:
+        print("No sample images found, set BENCH_OCR_IMAGES or add images to test_files")
+        return
+
+    for path in images:
+        with Image.open(path) as image:
+            print(f"\n{path} ({image.size[0]}x{image.size[1]})")
+
+        transcript_path = os.path.splitext(path)[0] + ".txt"
+        reference = None
+        if os.path.exists(transcript_path):
+            with open(transcript_path, encoding="utf-8") as f:
+                reference = f.read()
+
+        print(f"{'preset':>10} {'size':>11} {'prep s':>8} {'ocr s':>8} {'total s':>8} {'accuracy':>9}")
+        for preset in OCR_PRESETS:
+            (prep_seconds, ocr_seconds), text, size = run_preset(path, preset)
+            if reference is None:
+                # Without a transcript the unprocessed OCR is the baseline
+                reference = text
+            print(f"{preset:>10} {size[0]:>5}x{size[1]:<5} {prep_seconds:>8.2f} {ocr_seconds:>8.2f} "
+                  f"{prep_seconds + ocr_seconds:>8.2f} {word_accuracy(text, reference):>8.1%}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"Benchmark failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Sync Read Benchmark
+Measures how the full library read of SyncService scales with the number of decks,
+comparing the old serial per-deck reads with the current parallel reads.
+
+Runs against the Firestore emulator when FIRESTORE_EMULATOR_HOST is set, otherwise
+against the project configured through FIREBASE_CREDENTIALS / FIREBASE_PATH.
+Seeded data is written under a dedicated benchmark user and removed afterwards.
+"""
+
+import os
+import sys
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+from services.sync import SyncService
+
+load_dotenv()
+
+BENCH_USER_PREFIX = "benchmark-sync-"
+DECK_COUNTS = [int(n) for n in os.getenv("BENCH_DECK_COUNTS", "1,10,50,200").split(",")]
+CARDS_PER_DECK = int(os.getenv("BENCH_CARDS_PER_DECK", "20"))
+RUNS = int(os.getenv("BENCH_RUNS", "3"))
+
+
+def get_db():
+    """Firestore client for the emulator or the configured project"""
+    if os.getenv("FIRESTORE_EMULATOR_HOST"):
+        from google.cloud import firestore
+        return firestore.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "study-io-benchmark"))
+
+    from services.firebase_client import Firebase
+    return Firebase.init_db()
+
+
+def serial_read(db, user_id):
+    """The previous full library read: one cards stream per deck, one after another"""
+    decks_ref = db.collection("users").document(user_id).collection("decks")
+    decks = []
+    cards = []
+    for deck_doc in decks_ref.stream():
+        deck = deck_doc.to_dict()
+        deck["id"] = deck_doc.id
+        decks.append(deck)
+        for card_doc in decks_ref.document(deck_doc.id).collection("cards").stream():
+            card = card_doc.to_dict()
+            card["id"] = card_doc.id
+            card["deckId"] = deck_doc.id
+            cards.append(card)
+    return decks, cards
+
+
+def seed(db, user_id, deck_count):
+    """Write deck_count decks with CARDS_PER_DECK cards each"""
+    decks_ref = db.collection("users").document(user_id).collection("decks")
+    batch = db.batch()
+    writes = 0
+    for d in range(deck_count):
+        deck_id = str(uuid.uuid4())
+        batch.set(decks_ref.document(deck_id), {"id": deck_id, "name": f"Deck {d}"})
+        writes += 1
+        for c in range(CARDS_PER_DECK):
+            card_id = str(uuid.uuid4())
+            batch.set(decks_ref.document(deck_id).collection("cards").document(card_id),
+                      {"id": card_id, "deckId": deck_id, "front": f"Q{c}", "back": f"A{c}"})
+            writes += 1
+            if writes == 500:
+                batch.commit()
+                batch = db.batch()
+                writes = 0
+    if writes:
+        batch.commit()
+
+
+def cleanup(db, user_id):
+    """Delete every deck and card of the benchmark user"""
+    decks_ref = db.collection("users").document(user_id).collection("decks")
+    for deck_doc in decks_ref.stream():
+        for card_doc in decks_ref.document(deck_doc.id).collection("cards").stream():
+            card_doc.reference.delete()
+        deck_doc.reference.delete()
+
+
+def time_read(read):
+    """Best of RUNS wall clock timings in ms"""
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        read()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def main():
+    print("Sync Read Benchmark")
+    print("=" * 40)
+    db = get_db()
+    service = SyncService(db)
+
+    print(f"{'decks':>6} {'cards':>7} {'serial ms':>10} {'parallel ms':>12} {'speedup':>8}")
+    for deck_count in DECK_COUNTS:
+        user_id = BENCH_USER_PREFIX + str(uuid.uuid4())
+        try:
+            seed(db, user_id, deck_count)
+            serial_ms = time_read(lambda: serial_read(db, user_id))
+            parallel_ms = time_read(lambda: service._get_all_sync_data(user_id))
+            print(f"{deck_count:>6} {deck_count * CARDS_PER_DECK:>7} {serial_ms:>10.1f} "
+                  f"{parallel_ms:>12.1f} {serial_ms / parallel_ms:>7.1f}x")
+        finally:
+            cleanup(db, user_id)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"Benchmark failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,219 @@
+# Chunkers turn the extracted text of a document into the chunks sent to the LLM
+# Input is an iterable of pages, each a list of text blocks (paragraphs or headings)
+# as returned by PyMuPDF's get_text("blocks") or split from OCR output
+
+import math
+import os
+import re
+from typing import Iterable, Iterator, List, Optional
+
+# Context window of the models we use, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "google/gemini-2.5-flash-lite": 1_048_576,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+# Tokens kept free for the prompt template and the generated flashcards
+PROMPT_RESERVE_TOKENS = 2048
+
+# Tokens of document text per chunk. Larger chunks mean fewer LLM calls, but every
+# call returns at most 10 flashcards so very large chunks lose coverage
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", "2000"))
+# A trailing chunk below this share of the budget is merged into the previous one
+CHUNK_MIN_FILL = float(os.getenv("CHUNK_MIN_FILL", "0.25"))
+# A heading starts a new chunk once the current one is at least this full
+CHUNK_HEADING_FILL = 0.5
+
+# Bump whenever the chunking rules change so cached flashcards are regenerated
+CHUNKER_VERSION = "2"
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+NUMBERED_HEADING = re.compile(r'^(\d+(\.\d+)*\.?|[IVXLC]+\.|chapter|section|part)\s+\S', re.IGNORECASE)
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    Rough token count, about 4 characters per token for English text
+    '''
+    return math.ceil(len(text) / 4)
+
+
+def chunk_token_budget(model: str, budget: int = CHUNK_TOKEN_BUDGET) -> int:
+    '''
+    Token budget per chunk, capped so chunk and prompt fit the model's context
+    '''
+    context = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    return max(1, min(budget, context - PROMPT_RESERVE_TOKENS))
+
+
+def split_paragraphs(text: str) -> List[str]:
+    '''
+    Blocks of a plain text (e.g. OCR output), separated by blank lines
+    '''
+    return [block.strip() for block in re.split(r'\n\s*\n', text) if block.strip()]
+
+
+def is_heading(block: str) -> bool:
+    '''
+    Short blocks without closing punctuation, or numbered ones, are headings
+    '''
+    if len(block) > 120:
+        return False
+    if NUMBERED_HEADING.match(block):
+        return True
+    return len(block.split()) <= 12 and not block.rstrip().endswith(('.', ',', ';', ':', '?', '!'))
+
+
+def continues_paragraph(previous: str, block: str) -> bool:
+    '''
+    Whether block, the first of a page, carries on the previous page's last block
+    '''
+    return bool(previous) and not previous.rstrip().endswith(('.', '?', '!', ':')) and block[:1].islower()
+
+
+class WordChunker:
+    '''
+    Fixed slices of chunk_size words, ignoring the document structure
+    '''
+    def __init__(self, chunk_size: int = 1000):
+        self.chunk_size = chunk_size
+
+    @property
+    def signature(self) -> str:
+        return f"words:{self.chunk_size}"
+
+    def chunk(self, pages: Iterable[List[str]], empty_text: Optional[str] = None) -> Iterator[str]:
+        '''
+        Chunks are yielded as soon as they are full, so only the current
+        chunk's words are held in memory. Yields empty_text if there were no
+        words at all.
+        '''
+        words = []
+        chunk_count = 0
+        for blocks in pages:
+            for block in blocks:
+                for word in block.split():
+                    words.append(word)
+                    if len(words) == self.chunk_size:
+                        yield ' '.join(words)
+                        chunk_count += 1
+                        words = []
+
+        if words:
+            yield ' '.join(words)
+            chunk_count += 1
+        elif not chunk_count and empty_text:
+            yield empty_text
+
+
+class StructuredChunker:
+    '''
+    Packs whole paragraphs into chunks of up to token_budget tokens
+
+    Chunks end at paragraph boundaries, a heading starts a new chunk once the
+    current one is half full and is never left at the end of a chunk.
+    Paragraphs cut by a page break are joined again. Paragraphs larger than
+    the budget are split between sentences. A trailing chunk below
+    CHUNK_MIN_FILL of the budget is merged into the previous one, so the
+    last chunk can exceed the budget by that much. Holds at most two chunks.
+    '''
+    def __init__(self, token_budget: int = CHUNK_TOKEN_BUDGET, min_fill: float = CHUNK_MIN_FILL,
+                 count_tokens=estimate_tokens):
+        self.token_budget = token_budget
+        self.min_tokens = int(token_budget * min_fill)
+        self.count_tokens = count_tokens
+
+    @property
+    def signature(self) -> str:
+        return f"structured:{CHUNKER_VERSION}:{self.token_budget}:{self.min_tokens}"
+
+    def _paragraphs(self, pages: Iterable[List[str]]) -> Iterator[str]:
+        pending = None
+        for blocks in pages:
+            first_block = True
+            for block in blocks:
+                block = ' '.join(block.split())
+                if not block:
+                    continue
+                # Only a page break cuts paragraphs, blocks within a page stay apart
+                joins = first_block and pending is not None and continues_paragraph(pending, block)
+                first_block = False
+                if joins:
+                    pending = f"{pending} {block}"
+                    continue
+                if pending is not None:
+                    yield pending
+                pending = block
+        if pending is not None:
+            yield pending
+
+    def _pieces(self, paragraph: str) -> Iterator[str]:
+        '''
+        The paragraph itself, or sentences (and word runs) when it exceeds the budget
+        '''
+        if self.count_tokens(paragraph) <= self.token_budget:
+            yield paragraph
+            return
+        for sentence in SENTENCE_END.split(paragraph):
+            if self.count_tokens(sentence) <= self.token_budget:
+                yield sentence
+                continue
+            words = []
+            for word in sentence.split():
+                if words and self.count_tokens(' '.join(words + [word])) > self.token_budget:
+                    yield ' '.join(words)
+                    words = []
+                words.append(word)
+            if words:
+                yield ' '.join(words)
+
+    def _pack(self, pages: Iterable[List[str]]) -> Iterator[List[str]]:
+        current = []
+        tokens = 0
+        for paragraph in self._paragraphs(pages):
+            if is_heading(paragraph) and tokens >= self.token_budget * CHUNK_HEADING_FILL:
+                yield current
+                current, tokens = [], 0
+
+            for piece in self._pieces(paragraph):
+                piece_tokens = self.count_tokens(piece)
+                if current and tokens + piece_tokens > self.token_budget:
+                    # Keep a trailing heading together with the text it introduces
+                    carried = [current.pop()] if len(current) > 1 and is_heading(current[-1]) else []
+                    yield current
+                    current = carried
+                    tokens = sum(self.count_tokens(block) for block in carried)
+                current.append(piece)
+                tokens += piece_tokens
+        if current:
+            yield current
+
+    def chunk(self, pages: Iterable[List[str]], empty_text: Optional[str] = None) -> Iterator[str]:
+        # The last two chunks are held back until the end to know whether the tail is undersized
+        before_last, last = None, None
+        for blocks in self._pack(pages):
+            if before_last is not None:
+                yield '\n\n'.join(before_last)
+            before_last, last = last, blocks
+
+        if last is None:
+            if empty_text:
+                yield empty_text
+            return
+        if before_last is not None and self.count_tokens('\n\n'.join(last)) < self.min_tokens:
+            yield '\n\n'.join(before_last + last)
+            return
+        if before_last is not None:
+            yield '\n\n'.join(before_last)
+        yield '\n\n'.join(last)
+
+
+def create_chunker(name: str, chunk_size: int = 1000, model: Optional[str] = None):
+    '''
+    Build a chunker by name: 'structured' packs blocks up to the model's token
+    budget, 'words' keeps fixed chunk_size word slices
+    '''
+    if name == "words":
+        return WordChunker(chunk_size)
+    if name == "structured":
+        return StructuredChunker(chunk_token_budget(model) if model else CHUNK_TOKEN_BUDGET)
+    raise ValueError(f"Unknown chunker: {name}")
@@ -1,5 +1,5 @@
 # File processing utilities for PDFs and images
-# Supports text extraction from PDFs and OCR for images
+# Supports text extraction from PDFs and OCR for images and scanned PDF pages
 
 try:
     import fitz  # PyMuPDF
@@ -10,11 +10,45 @@ import pytesseract
 from PIL import Image
 import io
 import logging
+import multiprocessing
+import os
 import shutil
 import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from chunking import WordChunker, split_paragraphs
+from ocr_utils import OCR_PRESET, preprocess_image
 
 logger = logging.getLogger(__name__)
 
+def available_cpus():
+    """
+    Number of cores this process may run on, respecting CPU affinity and container limits
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# 'hybrid' OCRs PDF pages without a usable text layer, 'off' only reads the text layer
+PDF_OCR_MODE = os.getenv('PDF_OCR_MODE', 'hybrid')
+# Pages with fewer characters of text than this are treated as scanned
+PDF_OCR_MIN_CHARS = int(os.getenv('PDF_OCR_MIN_CHARS', '20'))
+# Resolution scanned pages are rendered at before OCR
+PDF_OCR_DPI = int(os.getenv('PDF_OCR_DPI', '300'))
+# OCR worker processes, defaults to the available cores
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', '0')) or available_cpus()
+# OCR Engine Mode 3, Page Segmentation Mode 6 (a single block of text)
+IMAGE_OCR_CONFIG = r'--oem 3 --psm 6'
+# Page Segmentation Mode 3 (automatic) suits full pages better than a single block
+PDF_OCR_CONFIG = r'--oem 3 --psm 3'
+
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+_tesseract_available = None
+
 class DependencyError(Exception):
     """Custom exception for missing dependencies"""
     pass
@@ -57,6 +91,59 @@ def check_tesseract_installation():
     except Exception as e:
         raise DependencyError(f"Failed to verify Tesseract installation: {str(e)}")
 
+def is_tesseract_available():
+    """
+    Cached check_tesseract_installation for the hybrid PDF path, which falls back to the text layer without it
+    """
+    global _tesseract_available
+    if _tesseract_available is None:
+        try:
+            _tesseract_available = check_tesseract_installation()
+        except DependencyError as e:
+            logger.warning(f"OCR of scanned PDF pages is disabled: {str(e)}")
+            _tesseract_available = False
+    return _tesseract_available
+
+def get_ocr_pool():
+    """
+    Process pool shared by all requests for OCR of scanned pages, created on first use
+    Tesseract is CPU bound, so pages are OCRed in separate processes rather than threads
+    """
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            # spawn: forking a process that runs request threads is not safe
+            _ocr_pool = ProcessPoolExecutor(
+                max_workers=OCR_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            logger.info(f"Started OCR pool with {OCR_WORKERS} processes")
+        return _ocr_pool
+
+def ocr_page_image(png_bytes, config=PDF_OCR_CONFIG, preset=OCR_PRESET):
+    """
+    Preprocess and OCR a rendered page in a pool process, returns (text, seconds spent)
+    """
+    started = time.perf_counter()
+    image = preprocess_image(Image.open(io.BytesIO(png_bytes)), preset, dpi=PDF_OCR_DPI)
+    text = pytesseract.image_to_string(image, config=config)
+    return text, time.perf_counter() - started
+
+def is_file_path(source):
+    """
+    Extraction accepts either the file bytes or a path to a spooled upload
+    """
+    return isinstance(source, (str, os.PathLike))
+
+def read_file_header(source, size=8):
+    """
+    Read the leading bytes used for file type detection without loading the whole file
+    """
+    if is_file_path(source):
+        with open(source, 'rb') as f:
+            return f.read(size)
+    return bytes(source[:size])
+
 def detect_file_type(file_bytes):
     """
     Detect file type based on file signature/magic bytes
@@ -75,50 +162,140 @@ def detect_file_type(file_bytes):
     else:
         return 'unknown'
 
-def extract_text_from_pdf(file_bytes, chunk_size=1000):
+def needs_ocr(page, page_text):
     """
-    Extract text from PDF files using PyMuPDF
+    A page needs OCR when it has images but no usable text layer
     """
-    try:
-        # Check PyMuPDF installation first
-        check_pymupdf_installation()
+    return (
+        PDF_OCR_MODE == 'hybrid'
+        and len(page_text.strip()) < PDF_OCR_MIN_CHARS
+        and bool(page.get_images())
+        and is_tesseract_available()
+    )
 
-        if not file_bytes:
-            raise ValueError("Empty PDF file provided")
+def read_pdf_page(page, page_num):
+    """
+    Text blocks of a page, or a Future of its OCR when the page is scanned
+    """
+    started = time.perf_counter()
+    # (x0, y0, x1, y1, text, block_no, block_type), type 1 are image blocks
+    blocks = [block[4] for block in page.get_text("blocks") if block[6] == 0]
+    if not needs_ocr(page, "".join(blocks)):
+        logger.info(f"PDF page {page_num + 1}: text layer in {time.perf_counter() - started:.3f}s")
+        return blocks
+
+    pixmap = page.get_pixmap(dpi=PDF_OCR_DPI, colorspace=fitz.csGRAY)
+    png_bytes = pixmap.tobytes("png")
+    logger.debug(f"PDF page {page_num + 1}: rendered for OCR in {time.perf_counter() - started:.3f}s")
+    return get_ocr_pool().submit(ocr_page_image, png_bytes)
+
+def collect_pdf_page(page_num, result, started):
+    """
+    Wait for a page read by read_pdf_page and return its blocks, None if OCR failed
+    """
+    if not isinstance(result, Future):
+        return result
+    try:
+        page_text, ocr_seconds = result.result()
+    except Exception as e:
+        logger.warning(f"Failed to OCR PDF page {page_num + 1}: {str(e)}")
+        return None
+    logger.info(
+        f"PDF page {page_num + 1}: OCR in {ocr_seconds:.3f}s, "
+        f"{time.perf_counter() - started:.3f}s including render and queueing"
+    )
+    return split_paragraphs(page_text)
 
-        doc = fitz.open(filetype="pdf", stream=file_bytes)
-        full_text = ""
+def iter_pdf_pages(doc):
+    """
+    Text blocks of each page of an open PyMuPDF document, closes it when done
 
+    Pages with a text layer take the fast path. Scanned pages are rendered
+    and OCRed in the process pool while the following pages are read, with
+    at most twice OCR_WORKERS pages in flight. Pages are yielded in order.
+    """
+    pending = deque()
+    try:
         for page_num, page in enumerate(doc):
             try:
-                page_text = page.get_text()
-                full_text += page_text
-                logger.debug(f"Extracted text from PDF page {page_num + 1}")
+                started = time.perf_counter()
+                pending.append((page_num, read_pdf_page(page, page_num), started))
             except Exception as e:
                 logger.warning(f"Failed to extract text from PDF page {page_num + 1}: {str(e)}")
                 continue
 
+            # Yield finished pages, only block on the oldest when too many OCR pages are in flight
+            in_flight = sum(isinstance(result, Future) for _, result, _ in pending)
+            while pending and (
+                    not isinstance(pending[0][1], Future) or pending[0][1].done() or in_flight >= OCR_WORKERS * 2):
+                done_page = pending.popleft()
+                in_flight -= isinstance(done_page[1], Future)
+                page_blocks = collect_pdf_page(*done_page)
+                if page_blocks is not None:
+                    yield page_blocks
+
+        while pending:
+            page_blocks = collect_pdf_page(*pending.popleft())
+            if page_blocks is not None:
+                yield page_blocks
+    finally:
+        for _, result, _ in pending:
+            if isinstance(result, Future):
+                result.cancel()
         doc.close()
 
-        if not full_text.strip():
-            return ["No text found in PDF file"]
+def stream_text_from_pdf(file_bytes, chunk_size=1000, chunker=None):
+    """
+    Lazily extract chunks from PDF files using PyMuPDF
+    The document is opened right away so invalid files raise here, pages are
+    then read as the returned generator is consumed. file_bytes can also be
+    a path, PyMuPDF then reads pages from disk on demand
+    chunker: see chunking.py, defaults to slices of chunk_size words
+    """
+    try:
+        # Check PyMuPDF installation first
+        check_pymupdf_installation()
+
+        if not file_bytes:
+            raise ValueError("Empty PDF file provided")
 
-        words = full_text.split()
-        chunks = [' '.join(words[i:i+chunk_size]) for i in range(0, len(words), chunk_size)]
+        if is_file_path(file_bytes):
+            doc = fitz.open(file_bytes, filetype="pdf")
+        else:
+            doc = fitz.open(filetype="pdf", stream=file_bytes)
 
-        logger.info(f"Successfully extracted {len(chunks)} chunks from PDF")
-        return chunks
+        chunker = chunker or WordChunker(chunk_size)
+        return chunker.chunk(iter_pdf_pages(doc), "No text found in PDF file")
 
     except fitz.FileDataError:
         raise ValueError("Invalid or corrupted PDF file")
-    except DependencyError:
+    except (ValueError, DependencyError):
         raise
     except Exception as e:
         raise Exception(f"PDF processing failed: {str(e)}")
 
-def extract_text_from_image(file_bytes, chunk_size=1000):
+def extract_text_from_pdf(file_bytes, chunk_size=1000, chunker=None):
+    """
+    Extract text from PDF files using PyMuPDF
+    file_bytes can also be a path, PyMuPDF then reads pages from disk on demand
+    """
+    chunks = list(stream_text_from_pdf(file_bytes, chunk_size, chunker))
+    logger.info(f"Successfully extracted {len(chunks)} chunks from PDF")
+    return chunks
+
+def extract_text_from_image(file_bytes, chunk_size=1000, chunker=None):
     """
     Extract text from image files using OCR (Tesseract)
+    file_bytes can also be a path to the image
+    """
+    chunks = list(stream_text_from_image(file_bytes, chunk_size, chunker))
+    logger.info(f"Successfully extracted {len(chunks)} chunks from image using OCR")
+    return chunks
+
+def stream_text_from_image(file_bytes, chunk_size=1000, chunker=None):
+    """
+    OCR an image (Tesseract) and return a generator over its chunks
+    file_bytes can also be a path to the image
     """
     try:
         # Check Tesseract installation first
@@ -127,34 +304,28 @@ def extract_text_from_image(file_bytes, chunk_size=1000):
         if not file_bytes:
             raise ValueError("Empty image file provided")
 
-        # Open image from bytes
-        image = Image.open(io.BytesIO(file_bytes))
+        # Open image from a path or from bytes
+        image = Image.open(file_bytes if is_file_path(file_bytes) else io.BytesIO(file_bytes))
         logger.debug(f"Opened image with mode: {image.mode}, size: {image.size}")
 
-        # Convert to RGB if necessary (for PNG with transparency)
-        if image.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-            image = background
-            logger.debug("Converted image with transparency to RGB")
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
-            logger.debug(f"Converted image from {image.mode} to RGB")
+        # Downscale and clean up the image first, OCR time grows with the pixel count
+        started = time.perf_counter()
+        image = preprocess_image(image, OCR_PRESET)
+        preprocessed = time.perf_counter()
 
         # Extract text using OCR with custom configuration for better accuracy
-        custom_config = r'--oem 3 --psm 6'  # OCR Engine Mode 3, Page Segmentation Mode 6
-        full_text = pytesseract.image_to_string(image, config=custom_config)
+        full_text = pytesseract.image_to_string(image, config=IMAGE_OCR_CONFIG)
+        logger.info(
+            f"OCR of image with preset '{OCR_PRESET}': preprocessing {preprocessed - started:.3f}s "
+            f"to {image.size[0]}x{image.size[1]}, OCR {time.perf_counter() - preprocessed:.3f}s"
+        )
 
         if not full_text.strip():
             logger.warning("No text detected in image")
-            return ["No text found in image"]
-        
-        words = full_text.split()
-        chunks = [' '.join(words[i:i+chunk_size]) for i in range(0, len(words), chunk_size)]
-
-        logger.info(f"Successfully extracted {len(chunks)} chunks from image using OCR")
-        return chunks
-        
+
+        chunker = chunker or WordChunker(chunk_size)
+        return chunker.chunk([split_paragraphs(full_text)], "No text found in image")
+
     except DependencyError:
         raise
     except ValueError:
@@ -162,18 +333,30 @@ def extract_text_from_image(file_bytes, chunk_size=1000):
     except Exception as e:
         raise Exception(f"OCR processing failed: {str(e)}")
 
-def extract_text_and_chunks(file_bytes, chunk_size=1000):
+def extract_text_and_chunks(file_bytes, chunk_size=1000, chunker=None):
     """
     Universal text extraction function that handles both PDFs and images
+    file_bytes is either the file content or a path to it
+    chunker: see chunking.py, defaults to slices of chunk_size words
+    """
+    return list(stream_text_and_chunks(file_bytes, chunk_size, chunker))
+
+def stream_text_and_chunks(file_bytes, chunk_size=1000, chunker=None):
+    """
+    Generator version of extract_text_and_chunks, chunks are yielded while
+    later pages are still being read so they can be sent to the LLM right away
+
+    The file type is checked and the file opened before returning, so
+    unsupported or invalid files raise here rather than while iterating.
     """
     try:
-        file_type = detect_file_type(file_bytes)
+        file_type = detect_file_type(read_file_header(file_bytes))
         logger.info(f"Detected file type: {file_type}")
 
         if file_type.lower() == 'pdf':
-            return extract_text_from_pdf(file_bytes, chunk_size)
+            return stream_text_from_pdf(file_bytes, chunk_size, chunker)
         elif file_type.lower() in ['png', 'jpeg', 'gif']:
-            return extract_text_from_image(file_bytes, chunk_size)
+            return stream_text_from_image(file_bytes, chunk_size, chunker)
         else:
             supported_types = "PDF, PNG, JPEG, GIF"
             raise ValueError(f"Unsupported file type: {file_type}. Only {supported_types} files are supported.")
@@ -0,0 +1,194 @@
+# Image preprocessing applied before OCR
+# Tesseract time grows with the pixel count, so photos are shrunk to the
+# resolution it works best at and cleaned up before they are OCRed
+
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class OcrPreset:
+    '''
+    Preprocessing steps applied before OCR
+    target_dpi: images with a higher known DPI are scaled down to it
+    max_pixels: images with more pixels are scaled down to it, phone photos carry no useful DPI.
+    Not applied to rendered PDF pages, whose DPI is exact
+    '''
+    target_dpi: Optional[int] = 300
+    max_pixels: Optional[int] = None
+    grayscale: bool = True
+    binarize: bool = False
+    deskew: bool = False
+    crop_margins: bool = False
+
+
+OCR_PRESETS = {
+    # The image as uploaded, only converted to RGB
+    "none": OcrPreset(target_dpi=None, grayscale=False),
+    "fast": OcrPreset(max_pixels=2_000_000, binarize=True, crop_margins=True),
+    "balanced": OcrPreset(max_pixels=4_000_000, binarize=True, deskew=True, crop_margins=True),
+    # Leaves thresholding to Tesseract, which copes better with uneven lighting
+    "quality": OcrPreset(max_pixels=8_000_000, deskew=True, crop_margins=True),
+}
+
+OCR_PRESET = os.getenv("OCR_PRESET", "balanced")
+if OCR_PRESET not in OCR_PRESETS:
+    raise ValueError(f"Unknown OCR preset: {OCR_PRESET}")
+
+# Skew angles tried by deskew, in degrees
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_STEP = 0.5
+# Whitespace kept around the text when cropping margins, in pixels
+CROP_PADDING = 20
+
+
+def flatten_to_rgb(image: Image.Image) -> Image.Image:
+    '''
+    RGB version of an image, transparent areas become white
+    '''
+    if image.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def scale_factor(size, preset: OcrPreset, dpi: Optional[float] = None, limit_pixels: bool = True) -> float:
+    '''
+    Factor to shrink an image of the given size by, never above 1
+    '''
+    factor = 1.0
+    if preset.target_dpi and dpi and dpi > preset.target_dpi:
+        factor = preset.target_dpi / dpi
+    if preset.max_pixels and limit_pixels:
+        pixels = size[0] * size[1] * factor * factor
+        if pixels > preset.max_pixels:
+            factor *= (preset.max_pixels / pixels) ** 0.5
+    return factor
+
+
+def otsu_threshold(histogram) -> int:
+    '''
+    Grey level that best separates ink from background in a 256 bin histogram
+    '''
+    total = sum(histogram)
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+    background_count = 0
+    background_sum = 0
+    best_variance = -1.0
+    threshold = 127
+    for level, count in enumerate(histogram):
+        background_count += count
+        if background_count == 0:
+            continue
+        foreground_count = total - background_count
+        if foreground_count == 0:
+            break
+        background_sum += level * count
+        background_mean = background_sum / background_count
+        foreground_mean = (weighted_total - background_sum) / foreground_count
+        variance = background_count * foreground_count * (background_mean - foreground_mean) ** 2
+        if variance > best_variance:
+            best_variance = variance
+            threshold = level
+    return threshold
+
+
+def estimate_skew(gray: Image.Image) -> float:
+    '''
+    Angle that makes the text lines horizontal, found with projection profiles
+    Rows of straight text alternate between full and empty, so the angle
+    whose row sums vary the most is the one that straightens the lines.
+    '''
+    small = gray.copy()
+    small.thumbnail((600, 600))
+    threshold = otsu_threshold(small.histogram())
+    ink = small.point(lambda p: 255 if p <= threshold else 0)
+
+    best_angle = 0.0
+    best_score = -1.0
+    steps = int(DESKEW_MAX_ANGLE / DESKEW_STEP)
+    for step in range(-steps, steps + 1):
+        angle = step * DESKEW_STEP
+        rotated = ink.rotate(angle, resample=Image.NEAREST, fillcolor=0)
+        # Box resize to a single column gives the mean ink of every row
+        rows = list(rotated.resize((1, rotated.height), Image.BOX).getdata())
+        mean = sum(rows) / len(rows)
+        score = sum((row - mean) ** 2 for row in rows)
+        if score > best_score:
+            best_score = score
+            best_angle = angle
+    return best_angle
+
+
+def crop_to_content(gray: Image.Image, threshold: int) -> Image.Image:
+    '''
+    Crop empty margins around the ink, keeping CROP_PADDING pixels
+    '''
+    box = gray.point(lambda p: 255 if p <= threshold else 0).getbbox()
+    if not box:
+        return gray
+    left, top, right, bottom = box
+    return gray.crop((
+        max(0, left - CROP_PADDING),
+        max(0, top - CROP_PADDING),
+        min(gray.width, right + CROP_PADDING),
+        min(gray.height, bottom + CROP_PADDING)
+    ))
+
+
+def preprocess_image(image: Image.Image, preset_name: str = OCR_PRESET, dpi: Optional[float] = None) -> Image.Image:
+    '''
+    Prepare an opened image for OCR with the steps of the named preset
+    dpi: resolution the image was rendered at, read from the file when not given.
+    A given dpi is trusted, the image is then only scaled to target_dpi
+    '''
+    preset = OCR_PRESETS[preset_name]
+    # A page rendered at a known DPI is as large as the text needs, file DPIs (often 72 on photos) are not
+    limit_pixels = dpi is None
+    if dpi is None and image.info.get('dpi'):
+        dpi = image.info['dpi'][0]
+
+    original_side = max(image.size)
+    factor = scale_factor(image.size, preset, dpi, limit_pixels)
+    if factor < 1 and image.format == 'JPEG':
+        # JPEGs can be decoded at a reduced scale, far cheaper than decoding then resizing.
+        # The draft picks the smallest scale that is still at least the requested size
+        image.draft('L' if preset.grayscale else 'RGB', (int(image.width * factor), int(image.height * factor)))
+    image = ImageOps.exif_transpose(image)
+    if not preset.grayscale:
+        image = flatten_to_rgb(image)
+    elif image.mode != 'L':
+        image = flatten_to_rgb(image).convert('L')
+
+    # The draft may already have shrunk the image, which lowers its DPI
+    if dpi:
+        dpi = dpi * max(image.size) / original_side
+    factor = scale_factor(image.size, preset, dpi, limit_pixels)
+    if factor < 1:
+        width, height = image.size
+        image = image.resize((max(1, int(width * factor)), max(1, int(height * factor))), Image.LANCZOS, reducing_gap=2.0)
+
+    if image.mode != 'L':
+        return image
+
+    if preset.deskew:
+        angle = estimate_skew(image)
+        if angle:
+            image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+            logger.debug(f"Deskewed image by {angle} degrees")
+
+    threshold = otsu_threshold(image.histogram())
+    if preset.crop_margins:
+        image = crop_to_content(image, threshold)
+    if preset.binarize:
+        image = image.point(lambda p: 255 if p > threshold else 0)
+    return image
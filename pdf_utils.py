@@ -3,17 +3,28 @@
 
 import fitz 
 
-def extract_text_and_chunks(pdf_file_bytes, chunk_size=1000):
+from chunking import WordChunker
+
+def iter_page_blocks(doc):
+    try:
+        for page in doc:
+            # Text blocks only, block type 1 are images
+            yield [block[4] for block in page.get_text("blocks") if block[6] == 0]
+    finally:
+        doc.close()
+
+def extract_text_and_chunks(pdf_file_bytes, chunk_size=1000, chunker=None):
+    return list(stream_text_and_chunks(pdf_file_bytes, chunk_size, chunker))
+
+def stream_text_and_chunks(pdf_file_bytes, chunk_size=1000, chunker=None):
+    # Chunks are yielded as pages are read, see chunking.py for the available chunkers
+    # The PDF is opened before returning, so an invalid file raises here rather than while iterating
     doc = fitz.open(filetype="pdf", stream=pdf_file_bytes)
     # doc = fitz.open(stream=pdf_file.read(), filetype="pdf")
-    full_text = ""
-    for page in doc:
-        full_text += page.get_text()
-    words = full_text.split()
-    chunks = [' '.join(words[i:i+chunk_size]) for i in range(0, len(words), chunk_size)]
-    return chunks
+    chunker = chunker or WordChunker(chunk_size)
+    return chunker.chunk(iter_page_blocks(doc))
 
 #testing
 # with open("test_files/cs446-d1-study.io.pdf", "rb") as f:
-#     chunks = extract_text_and_chunks(f)
+#     chunks = extract_text_and_chunks(f.read())
 #     print(chunks)  
\ No newline at end of file
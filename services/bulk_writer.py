@@ -0,0 +1,144 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, InvalidArgument, NotFound
+
+logger = logging.getLogger(__name__)
+
+# Firestore rejects batches with more writes than this
+FIRESTORE_BATCH_LIMIT = 500
+# Number of batches committed at the same time
+BULK_WRITE_CONCURRENCY = int(os.getenv("BULK_WRITE_CONCURRENCY", "4"))
+
+# Errors caused by the data of a document, raised by Firestore or while the client encodes it.
+# Anything else (Unavailable, DeadlineExceeded, PermissionDenied, ...) fails a batch as a whole
+PER_DOCUMENT_ERRORS = (InvalidArgument, FailedPrecondition, NotFound, AlreadyExists, TypeError, ValueError)
+
+
+@dataclass
+class WriteItem:
+    '''
+    One logical item, e.g. a card, made of writes that are always committed together
+    writes: (document reference, data) pairs, data None deletes the document
+    '''
+    kind: str
+    id: str
+    writes: List[Tuple[Any, Optional[dict]]] = field(default_factory=list)
+
+
+@dataclass
+class WriteResult:
+    kind: str
+    id: str
+    success: bool
+    error: Optional[str] = None
+
+
+class BulkWriter:
+    '''
+    Commits any number of write items as limit respecting Firestore batches
+    Batches are committed concurrently. When a batch is rejected because of
+    a document's data it is split in halves and retried until the failing
+    items are isolated, so one bad document only fails itself. Other errors
+    say nothing about single documents, the batch is retried whole with
+    backoff and then failed, so an outage does not multiply the commits.
+    '''
+    def __init__(self, db, batch_limit: int = FIRESTORE_BATCH_LIMIT,
+                 max_workers: int = BULK_WRITE_CONCURRENCY, max_retries: int = 2, retry_delay: float = 0.5):
+        self.db = db
+        self.batch_limit = batch_limit
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def _slices(self, items: List[WriteItem]) -> List[List[WriteItem]]:
+        slices = []
+        current = []
+        current_writes = 0
+        for item in items:
+            if len(item.writes) > self.batch_limit:
+                raise ValueError(f"{item.kind} {item.id} has more than {self.batch_limit} writes")
+            if current and current_writes + len(item.writes) > self.batch_limit:
+                slices.append(current)
+                current, current_writes = [], 0
+            current.append(item)
+            current_writes += len(item.writes)
+        if current:
+            slices.append(current)
+        return slices
+
+    def _commit(self, items: List[WriteItem]):
+        batch = self.db.batch()
+        for item in items:
+            for ref, data in item.writes:
+                if data is None:
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data)
+        batch.commit()
+
+    def _commit_with_retries(self, items: List[WriteItem]) -> Optional[Exception]:
+        '''
+        Commit the items as one batch, retrying errors that are not per document
+        Returns the error it gave up on, None once the batch is committed
+        '''
+        for attempt in range(self.max_retries):
+            try:
+                self._commit(items)
+                return None
+            except PER_DOCUMENT_ERRORS as e:
+                return e
+            except Exception as e:
+                error = e
+                if attempt < self.max_retries - 1:
+                    logger.warning(f"Batch of {len(items)} items failed, retrying: {str(e)}")
+                    time.sleep(self.retry_delay * (2 ** attempt))
+        return error
+
+    def _write_slice(self, items: List[WriteItem]) -> List[WriteResult]:
+        error = self._commit_with_retries(items)
+        if error is None:
+            return [WriteResult(item.kind, item.id, True) for item in items]
+        if len(items) > 1 and isinstance(error, PER_DOCUMENT_ERRORS):
+            logger.warning(f"Batch of {len(items)} items was rejected, retrying in halves: {str(error)}")
+            middle = len(items) // 2
+            return self._write_slice(items[:middle]) + self._write_slice(items[middle:])
+
+        if len(items) == 1:
+            logger.error(f"Failed to write {items[0].kind} {items[0].id}: {str(error)}")
+        else:
+            logger.error(f"Failed to write a batch of {len(items)} items: {str(error)}")
+        return [WriteResult(item.kind, item.id, False, str(error)) for item in items]
+
+    def write(self, items: List[WriteItem]) -> List[WriteResult]:
+        '''
+        Returns one WriteResult per item, in the order the items were given
+        '''
+        slices = self._slices(items)
+        if not slices:
+            return []
+        if len(slices) == 1:
+            return self._write_slice(slices[0])
+
+        results = []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(slices)), thread_name_prefix="bulk-write") as executor:
+            for slice_results in executor.map(self._write_slice, slices):
+                results.extend(slice_results)
+        return results
+
+
+def summarize_results(results: List[WriteResult]) -> dict:
+    '''
+    Compact per-item report for API responses: a count of written items and the failures
+    '''
+    return {
+        "written": sum(1 for result in results if result.success),
+        "failed": [
+            {"kind": result.kind, "id": result.id, "error": result.error}
+            for result in results if not result.success
+        ]
+    }
@@ -5,6 +5,19 @@ import uuid
 import time
 from enum import Enum
 from services.models import Deck, Card
+from services.bulk_writer import BulkWriter, WriteItem
+from services.library_cache import library_cache
+from services.library_version import library_versions
+from services.sync import OWNER_FIELD, UPDATED_AT_FIELD
+
+def to_document(model) -> dict:
+    '''
+    Dataclass model to a Firestore document, enums are stored by value
+    '''
+    return {
+        key: value.value if isinstance(value, Enum) else value
+        for key, value in model.__dict__.items()
+    }
 
 class CreateDeckAndCard:
     '''
@@ -13,30 +26,96 @@ class CreateDeckAndCard:
     def __init__(self, db, uid: str):
         self.db = db
         self.uid = uid
-    def create_deck(self, deck_name: str) -> dict:
+    def _server_fields(self) -> dict:
+        # Same fields SyncService stamps, so generated decks show up in delta syncs
+        return {UPDATED_AT_FIELD: int(time.time() * 1000), OWNER_FIELD: self.uid}
+
+    def _deck_ref(self, deck_id: str):
+        return self.db.collection("users").document(self.uid)\
+            .collection("decks").document(deck_id)
+
+    def build_deck(self, deck_name: str) -> dict:
         '''
-        uid: comes from the validated user token
-        deck_name: name for the deck gen by LLM
+        Deck document for deck_name, not written yet
         '''
         deck_id = str(uuid.uuid4())
         deck = Deck(id=deck_id, name=deck_name)
-        deck_dict = deck.__dict__.copy()
+        deck_dict = to_document(deck)
         deck_dict["createdAt"] = int(time.time())
-        self.db.collection("users").document(self.uid)\
-            .collection("decks").document(deck_id).set(deck_dict)
+        deck_dict.update(self._server_fields())
         return deck_dict
-        
-    def create_card(self, deck_id: str, front: str, back: str) -> dict:
+
+    def build_card(self, deck_id: str, front: str, back: str) -> dict:
+        '''
+        Card document for the deck, not written yet
+        '''
         card_id = str(uuid.uuid4())
         card = Card(id=card_id, deckId=deck_id, front=front, back=back)
-        card_dict = card.__dict__.copy()
+        card_dict = to_document(card)
         card_dict["createdAt"] = int(time.time())
-        self.db.collection("users").document(self.uid) \
-            .collection("decks").document(deck_id) \
-            .collection("cards").document(card_id).set(card_dict)
+        card_dict.update(self._server_fields())
         return card_dict
 
-    def convert_llm_response(self, content: list, file_name: str) -> list:
+    def create_deck(self, deck_name: str) -> dict:
+        '''
+        uid: comes from the validated user token
+        deck_name: name for the deck gen by LLM
+        '''
+        deck_dict = self.build_deck(deck_name)
+        self._deck_ref(deck_dict["id"]).set(deck_dict)
+        library_versions.bump(self.uid)
+        library_cache.apply(self.uid, decks=[deck_dict])
+        return deck_dict
+        
+    def create_card(self, deck_id: str, front: str, back: str) -> dict:
+        card_dict = self.build_card(deck_id, front, back)
+        self._deck_ref(deck_id).collection("cards").document(card_dict["id"]).set(card_dict)
+        library_versions.bump(self.uid)
+        library_cache.apply(self.uid, cards=[card_dict])
+        return card_dict
+
+    def save_deck_and_cards(self, deck: dict, cards: list) -> list:
+        '''
+        Write a built deck and its cards with batched commits
+        The deck is committed first so no card is left without its deck, then
+        the cards are committed by BulkWriter in concurrent batches. Returns
+        the failures as [{"kind", "id", "error"}], if the deck fails so do
+        all of its cards.
+        '''
+        # Stamped again at write time, documents may have been built a while ago
+        deck = {**deck, **self._server_fields()}
+        deck_result = BulkWriter(self.db).write([WriteItem("deck", deck["id"], [(self._deck_ref(deck["id"]), deck)])])[0]
+        if not deck_result.success:
+            return [{"kind": "deck", "id": deck["id"], "error": deck_result.error}] + [
+                {"kind": "card", "id": card["id"], "error": "Deck could not be saved"} for card in cards
+            ]
+
+        library_versions.bump(self.uid)
+        library_cache.apply(self.uid, decks=[deck])
+        return self.save_cards(cards)
+
+    def save_cards(self, cards: list) -> list:
+        '''
+        Write built cards of existing decks with batched commits
+        Returns the failures as [{"kind", "id", "error"}]
+        '''
+        cards = [{**card, **self._server_fields()} for card in cards]
+        results = BulkWriter(self.db).write([
+            WriteItem("card", card["id"], [
+                (self._deck_ref(card["deckId"]).collection("cards").document(card["id"]), card)
+            ])
+            for card in cards
+        ])
+        saved_cards = [card for card, result in zip(cards, results) if result.success]
+        if saved_cards:
+            library_versions.bump(self.uid)
+            library_cache.apply(self.uid, cards=saved_cards)
+        return [
+            {"kind": result.kind, "id": result.id, "error": result.error}
+            for result in results if not result.success
+        ]
+
+    def convert_llm_response(self, content: list, file_name: str) -> tuple:
         '''
         Assuming the llm has the following response
         {
@@ -47,19 +126,19 @@ class CreateDeckAndCard:
         Current architecture choice:
         For each document, llm makes a deck
         This deck has a collection of cards
+        Returns (saved cards, deck, failures), see save_deck_and_cards
         '''
         # Make one deck for each file
-        llm_deck = self.create_deck(file_name)
-        completed_cards = []
-        # Iter over the cards in the content and make a card 
+        llm_deck = self.build_deck(file_name)
+        llm_cards = []
+        failed = []
         for card in content:
             try:
-                new_card = self.create_card(llm_deck["id"], card["front"], card["back"])
-                completed_cards.append(new_card)
-            # Maybe dont want this card creation to be blocking
-            except Exception as e:
-                print('Error in card creation: ', e)
-                continue
-        return (completed_cards, llm_deck)
-                
-            
\ No newline at end of file
+                llm_cards.append(self.build_card(llm_deck["id"], card["front"], card["back"]))
+            except (KeyError, TypeError) as e:
+                failed.append({"kind": "card", "id": None, "error": f"Invalid card: {str(e)}"})
+
+        failed += self.save_deck_and_cards(llm_deck, llm_cards)
+        failed_ids = {failure["id"] for failure in failed}
+        completed_cards = [card for card in llm_cards if card["id"] not in failed_ids]
+        return (completed_cards, llm_deck, failed)
@@ -2,17 +2,25 @@ from typing import Any
 
 import firebase_admin
 from firebase_admin import auth, credentials, firestore
+import hashlib
 import os
 import json
+import time
 from dotenv import load_dotenv
 
+from services.cache import LRUCache
+
 load_dotenv()
 FIREBASE_PATH = os.getenv("FIREBASE_PATH")
 FIREBASE_CREDENTIALS = os.getenv("FIREBASE_CREDENTIALS")
+# Number of verified ID tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
 
 class Firebase:
     _app = None
     _db = None
+    # sha256(token) -> uid of tokens that passed verification, expiring with the token
+    _token_cache = LRUCache(max_entries=max(TOKEN_CACHE_MAX_ENTRIES, 1))
     
     @classmethod
     def init_db(cls):
@@ -34,16 +42,36 @@ class Firebase:
             cls._db = firestore.client()
         return cls._db
 
-    @staticmethod
-    def verify_token(token: str):
+    @classmethod
+    def verify_token(cls, token: str):
         '''
         Given a login token verify the user before allowing them to access the service
         Returns the user ID string if valid, None if invalid
+        Verified tokens are cached until their exp claim so repeat requests skip
+        signature verification
         '''
+        token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        if TOKEN_CACHE_MAX_ENTRIES:
+            uid = cls._token_cache.get(token_hash)
+            if uid:
+                return uid
+
         try:
             decoded = auth.verify_id_token(token)
+            remaining = decoded.get("exp", 0) - time.time()
+            if TOKEN_CACHE_MAX_ENTRIES and remaining > 0:
+                cls._token_cache.set(token_hash, decoded["uid"], ttl=remaining)
             return decoded["uid"]
         except Exception as e:
             # Log the error and return None instead of the exception object
             print(f"Token verification failed: {str(e)}")
             return None
+
+    @classmethod
+    def token_cache_stats(cls) -> dict:
+        '''
+        Hit rate of the verified token cache
+        '''
+        stats = cls._token_cache.stats.to_dict()
+        stats["entries"] = len(cls._token_cache)
+        return stats
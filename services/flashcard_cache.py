@@ -0,0 +1,68 @@
+import hashlib
+import logging
+import os
+from typing import List, Optional
+
+from services.cache import create_cache
+from services.llm import LLM_MODEL, PROMPT_VERSION
+
+logger = logging.getLogger(__name__)
+
+FLASHCARD_CACHE_BACKEND = os.getenv("FLASHCARD_CACHE_BACKEND", "tiered")
+FLASHCARD_CACHE_TTL = float(os.getenv("FLASHCARD_CACHE_TTL", str(30 * 24 * 60 * 60)))
+FLASHCARD_CACHE_MAX_ENTRIES = int(os.getenv("FLASHCARD_CACHE_MAX_ENTRIES", "256"))
+
+
+class FlashcardCache:
+    '''
+    Content addressed cache of the flashcards generated for a whole file
+    Keyed on the SHA-256 of the decoded file together with everything that
+    changes the LLM output, so a re-upload of the same file skips both text
+    extraction and OpenRouter.
+    '''
+    def __init__(self, backend: str = FLASHCARD_CACHE_BACKEND):
+        self.backend = backend
+        self._cache = create_cache(
+            "flashcards",
+            backend=backend,
+            max_entries=FLASHCARD_CACHE_MAX_ENTRIES,
+            ttl=FLASHCARD_CACHE_TTL
+        )
+
+    @staticmethod
+    def hash_file(source) -> str:
+        '''
+        SHA-256 of the file bytes, paths are hashed in blocks to keep memory flat
+        '''
+        if not isinstance(source, (str, os.PathLike)):
+            return hashlib.sha256(source).hexdigest()
+        digest = hashlib.sha256()
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @classmethod
+    def make_key(cls, source, chunker_signature: str) -> str:
+        '''
+        source: the file bytes or a path to the file
+        chunker_signature: signature of the chunker that split the file
+        Hashes the whole file, compute it once per upload and pass it to get and set
+        '''
+        file_hash = cls.hash_file(source)
+        return f"{file_hash}:{chunker_signature}:{PROMPT_VERSION}:{LLM_MODEL}"
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        cards = self._cache.get(key)
+        if cards is not None:
+            logger.info(f"Flashcard cache hit, returning {len(cards)} cached cards")
+        return cards
+
+    def set(self, key: str, cards: List[dict]):
+        self._cache.set(key, cards)
+
+    def stats(self) -> dict:
+        stats = self._cache.stats.to_dict()
+        stats["backend"] = self.backend
+        stats["entries"] = len(self._cache)
+        return stats
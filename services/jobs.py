@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from enum import Enum
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.getenv("JOBS_DIR", ".jobs")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+# Finished jobs are purged after this many seconds
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(7 * 24 * 60 * 60)))
+# Seconds a running job stays claimed without its worker renewing the lease,
+# after that it counts as interrupted and any worker may run it again
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class JobProgress:
+    '''
+    Handed to the job handler to record progress and per-chunk results
+    '''
+    def __init__(self, queue: "JobQueue", job_id: str, user_id: str, file_name: str):
+        self._queue = queue
+        self.job_id = job_id
+        self.user_id = user_id
+        self.file_name = file_name
+
+    def set_total(self, total_chunks: int):
+        self._queue._execute(
+            "UPDATE jobs SET total_chunks = ?, updated_at = ? WHERE id = ?",
+            (total_chunks, time.time(), self.job_id)
+        )
+
+    def chunk_done(self, index: int, cards: List[dict], error: Optional[str] = None):
+        self._queue._execute(
+            "INSERT OR REPLACE INTO job_chunks (job_id, chunk_index, cards, error) VALUES (?, ?, ?, ?)",
+            (self.job_id, index, json.dumps(cards), error)
+        )
+
+
+class JobQueue:
+    '''
+    Durable flashcard generation queue backed by SQLite
+    Uploaded files are spooled to JOBS_DIR and drained by a pool of worker
+    threads, so generation concurrency is independent of HTTP concurrency.
+    A claimed job holds a lease that its process renews while it runs. Jobs
+    whose lease ran out, because the process stopped, are claimed again, and
+    jobs another live process is running are left alone.
+
+    handler: called as handler(payload_path, progress) for every job
+    '''
+    def __init__(self, handler: Callable[[str, JobProgress], None],
+                 directory: str = JOBS_DIR, workers: int = JOB_WORKERS):
+        self.handler = handler
+        self.directory = directory
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        # Unique per process: after a restart the hostname and often the pid are the same,
+        # and this process must not renew the leases of the jobs its predecessor was running
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, "jobs.sqlite3"), check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, user_id TEXT NOT NULL, file_name TEXT NOT NULL, "
+            "status TEXT NOT NULL, payload_path TEXT, total_chunks INTEGER, error TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);"
+            "CREATE TABLE IF NOT EXISTS job_chunks ("
+            "job_id TEXT NOT NULL, chunk_index INTEGER NOT NULL, cards TEXT NOT NULL, error TEXT, "
+            "PRIMARY KEY (job_id, chunk_index));"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        self._conn.commit()
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._conn.commit()
+            return cursor
+
+    def _query(self, sql: str, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def start(self):
+        '''
+        Purge expired jobs and start the workers and the lease renewal, once per process
+        '''
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            self._purge_expired()
+
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._renew_leases, name="job-leases", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, user_id: str, file_name: str, source) -> str:
+        '''
+        source: the file bytes or the path of a spooled upload, which is moved into the queue
+        '''
+        job_id = str(uuid.uuid4())
+        payload_path = os.path.join(self.directory, f"{job_id}.bin")
+        if isinstance(source, (str, os.PathLike)):
+            shutil.move(source, payload_path)
+        else:
+            with open(payload_path, "wb") as f:
+                f.write(source)
+
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (id, user_id, file_name, status, payload_path, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, user_id, file_name, JobStatus.QUEUED.value, payload_path, now, now)
+        )
+        self._wakeup.set()
+        logger.info(f"Queued job {job_id} for user {user_id}")
+        return job_id
+
+    def get(self, job_id: str, user_id: str) -> Optional[dict]:
+        '''
+        Return the job with its per-chunk results, None if it does not belong to the user
+        '''
+        rows = self._query(
+            "SELECT id, file_name, status, total_chunks, error, created_at, updated_at "
+            "FROM jobs WHERE id = ? AND user_id = ?",
+            (job_id, user_id)
+        )
+        if not rows:
+            return None
+        job_id, file_name, status, total_chunks, error, created_at, updated_at = rows[0]
+
+        chunks = [
+            {"index": index, "cards": json.loads(cards), "error": chunk_error}
+            for index, cards, chunk_error in self._query(
+                "SELECT chunk_index, cards, error FROM job_chunks WHERE job_id = ? ORDER BY chunk_index",
+                (job_id,)
+            )
+        ]
+        return {
+            "id": job_id,
+            "file_name": file_name,
+            "status": status,
+            "error": error,
+            "total_chunks": total_chunks,
+            "completed_chunks": len(chunks),
+            "failed_chunks": [chunk["index"] for chunk in chunks if chunk["error"]],
+            "chunks": chunks,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+
+    def _claim(self) -> Optional[tuple]:
+        '''
+        Take the oldest queued job, or a running one whose lease ran out
+        '''
+        now = time.time()
+        claimable = "(status = ? OR (status = ? AND (lease_until IS NULL OR lease_until < ?)))"
+        claimable_params = (JobStatus.QUEUED.value, JobStatus.RUNNING.value, now)
+        rows = self._query(
+            f"SELECT id, payload_path, user_id, file_name, status FROM jobs WHERE {claimable} "
+            "ORDER BY created_at LIMIT 1",
+            claimable_params
+        )
+        if not rows:
+            return None
+        job_id, payload_path, user_id, file_name, status = rows[0]
+        claimed = self._execute(
+            f"UPDATE jobs SET status = ?, owner = ?, lease_until = ?, updated_at = ? WHERE id = ? AND {claimable}",
+            (JobStatus.RUNNING.value, self.owner, now + JOB_LEASE, now, job_id) + claimable_params
+        ).rowcount
+        if not claimed:
+            return None
+        if status == JobStatus.RUNNING.value:
+            logger.info(f"Resuming interrupted job {job_id}")
+        return job_id, payload_path, user_id, file_name
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(JOB_LEASE / 3)
+            try:
+                self._execute(
+                    "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = ?",
+                    (time.time() + JOB_LEASE, self.owner, JobStatus.RUNNING.value)
+                )
+            except sqlite3.Error as e:
+                logger.error(f"Could not renew job leases: {str(e)}")
+
+    def _work(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                self._wakeup.wait(timeout=1)
+                self._wakeup.clear()
+                continue
+            self._run(*job)
+
+    def _run(self, job_id: str, payload_path: str, user_id: str, file_name: str):
+        logger.info(f"Running job {job_id}")
+        status, error = JobStatus.COMPLETED, None
+        try:
+            self.handler(payload_path, JobProgress(self, job_id, user_id, file_name))
+
+            results = self._query(
+                "SELECT COUNT(*), COUNT(error) FROM job_chunks WHERE job_id = ?", (job_id,)
+            )[0]
+            if results[0] and results[0] == results[1]:
+                status, error = JobStatus.FAILED, "Failed to generate flashcards for every chunk"
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            status, error = JobStatus.FAILED, str(e)
+
+        finished = self._execute(
+            "UPDATE jobs SET status = ?, error = ?, payload_path = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND owner = ?",
+            (status.value, error, time.time(), job_id, self.owner)
+        ).rowcount
+        if not finished:
+            # The lease ran out and another worker took the job over, it owns the payload now
+            logger.warning(f"Job {job_id} was taken over by another worker, dropping this run's status")
+            return
+        self._remove_payload(payload_path)
+        logger.info(f"Job {job_id} finished with status {status.value}")
+
+    def _purge_expired(self):
+        cutoff = time.time() - JOB_RETENTION
+        expired = self._query(
+            "SELECT id FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (JobStatus.COMPLETED.value, JobStatus.FAILED.value, cutoff)
+        )
+        for (job_id,) in expired:
+            self._execute("DELETE FROM job_chunks WHERE job_id = ?", (job_id,))
+            self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    @staticmethod
+    def _remove_payload(payload_path: str):
+        try:
+            os.remove(payload_path)
+        except OSError:
+            pass
@@ -0,0 +1,72 @@
+import json
+import logging
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+
+class JsonArrayStreamParser:
+    '''
+    Incremental parser for a JSON array of objects arriving in pieces
+    feed() returns the objects completed by the new text as soon as their
+    closing brace arrives. Anything before the opening bracket, like a
+    ```json fence, is skipped. A truncated or malformed object only loses
+    itself, the objects before it have already been returned.
+    '''
+    def __init__(self):
+        self.started = False
+        self.closed = False
+        self.errors = 0
+        # Nesting depth, 1 directly inside the top-level array
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._current = []
+
+    def feed(self, text: str) -> List[dict]:
+        objects = []
+        for char in text:
+            if self.closed:
+                break
+            if not self.started:
+                if char == '[':
+                    self.started = True
+                    self._depth = 1
+                continue
+
+            if self._depth >= 2:
+                self._current.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                if self._depth == 1:
+                    self._current = [char]
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 1:
+                    value = self._decode()
+                    if isinstance(value, dict):
+                        objects.append(value)
+                elif self._depth == 0:
+                    self.closed = True
+        return objects
+
+    def _decode(self):
+        text = ''.join(self._current)
+        self._current = []
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError as e:
+            self.errors += 1
+            logger.warning(f"Skipping malformed object in streamed array: {e}")
+            return None
@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from services.cache import CacheStats, LRUCache
+from services.library_version import library_versions
+
+# Memory budget for cached libraries across all users
+LIBRARY_CACHE_MAX_BYTES = int(os.getenv("LIBRARY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+LIBRARY_CACHE_MAX_USERS = int(os.getenv("LIBRARY_CACHE_MAX_USERS", "10000"))
+# Seconds a library read from Firestore is served from the cache. Writes made on other
+# machines are not seen by this one's cache, so this bounds how stale a full sync can be
+LIBRARY_CACHE_TTL = float(os.getenv("LIBRARY_CACHE_TTL", "300"))
+
+
+def _document_size(document: dict) -> int:
+    return len(json.dumps(document, default=str))
+
+
+class CachedLibrary:
+    '''
+    One user's decks and cards with an estimate of their serialized size
+    Documents are never mutated in place, updates replace them, so lists
+    handed out by to_lists stay valid while the library keeps changing.
+    '''
+    def __init__(self):
+        self.decks: Dict[str, dict] = {}
+        self.cards: Dict[Tuple[str, str], dict] = {}
+        self.size = 0
+        self.loaded_at = time.time()
+
+    def put_deck(self, deck: dict):
+        self.remove_deck(deck["id"], keep_cards=True)
+        self.decks[deck["id"]] = deck
+        self.size += _document_size(deck)
+
+    def put_card(self, card: dict):
+        key = (card["deckId"], card["id"])
+        self.remove_card(*key)
+        self.cards[key] = card
+        self.size += _document_size(card)
+
+    def remove_deck(self, deck_id: str, keep_cards: bool = False):
+        deck = self.decks.pop(deck_id, None)
+        if deck is not None:
+            self.size -= _document_size(deck)
+        if not keep_cards:
+            for key in [key for key in self.cards if key[0] == deck_id]:
+                self.remove_card(*key)
+
+    def remove_card(self, deck_id: str, card_id: str):
+        card = self.cards.pop((deck_id, card_id), None)
+        if card is not None:
+            self.size -= _document_size(card)
+
+    def to_lists(self) -> Tuple[List[dict], List[dict]]:
+        # Cards of decks that do not exist are not returned by a Firestore read either
+        cards = [card for (deck_id, _), card in self.cards.items() if deck_id in self.decks]
+        return list(self.decks.values()), cards
+
+
+class LibraryCache:
+    '''
+    Write-through cache of each user's full library in front of Firestore
+    Populated by the first full read of a user and kept current by every
+    successful write through SyncService and CreateDeckAndCard. Users are
+    evicted least recently used first once LIBRARY_CACHE_MAX_BYTES is used.
+    A library expires LIBRARY_CACHE_TTL after it was read, local writes do
+    not extend that since they do not bring in writes of other machines.
+
+    backend: any cache with get/set/delete, defaults
+    to an in-process LRUCache bounded by the libraries' estimated size
+    '''
+    def __init__(self, backend=None):
+        self._backend = backend or LRUCache(
+            max_entries=LIBRARY_CACHE_MAX_USERS,
+            max_bytes=LIBRARY_CACHE_MAX_BYTES,
+            sizeof=lambda library: library.size,
+            ttl=LIBRARY_CACHE_TTL
+        )
+        # Only reads are counted, lookups done by writes would skew the hit rate
+        self._stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[Tuple[List[dict], List[dict]]]:
+        '''
+        Returns (decks, cards) of a cached user, None on a miss
+        '''
+        with self._lock:
+            library = self._backend.get(user_id)
+            lists = library.to_lists() if library is not None else None
+        self._stats.record(lists is not None)
+        return lists
+
+    def put(self, user_id: str, decks: List[dict], cards: List[dict], library_version: Optional[str] = None):
+        '''
+        Cache a library read from Firestore
+        library_version: version taken before the read, if a write bumped it
+        since then the read may be stale and is not cached
+        '''
+        library = CachedLibrary()
+        for deck in decks:
+            library.put_deck(deck)
+        for card in cards:
+            library.put_card(card)
+        with self._lock:
+            if library_version is not None and library_versions.get(user_id) != library_version:
+                return
+            self._backend.set(user_id, library)
+
+    def apply(self, user_id: str, decks: List[dict] = (), cards: List[dict] = (),
+              deleted_decks: List[str] = (), deleted_cards: List[dict] = ()):
+        '''
+        Write-through of successful writes, users that are not cached are left alone
+        '''
+        with self._lock:
+            library = self._backend.get(user_id)
+            if library is None:
+                return
+            for deck_id in deleted_decks:
+                library.remove_deck(deck_id)
+            for card in deleted_cards:
+                library.remove_card(card["deckId"], card["id"])
+            for deck in decks:
+                library.put_deck(deck)
+            for card in cards:
+                library.put_card(card)
+            # Re-set so the size bound accounts for the change, keeping the expiry of the read
+            remaining = LIBRARY_CACHE_TTL - (time.time() - library.loaded_at)
+            if remaining > 0:
+                self._backend.set(user_id, library, ttl=remaining)
+            else:
+                self._backend.delete(user_id)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._backend.delete(user_id)
+
+    def stats(self) -> dict:
+        stats = self._stats.to_dict()
+        stats["users"] = len(self._backend)
+        stats["resident_bytes"] = getattr(self._backend, "resident_bytes", None)
+        return stats
+
+
+library_cache = LibraryCache()
@@ -0,0 +1,49 @@
+import os
+import uuid
+from typing import Optional
+
+from services.cache import LRUCache
+
+LIBRARY_VERSION_MAX_USERS = int(os.getenv("LIBRARY_VERSION_MAX_USERS", "100000"))
+# Seconds a version stays valid, writes made on other machines do not bump it here,
+# so this bounds how long a client can be told not_modified after one of them
+LIBRARY_VERSION_TTL = float(os.getenv("LIBRARY_VERSION_TTL", "300"))
+
+
+class LibraryVersions:
+    '''
+    In-process version (ETag) of each user's library
+    Every write through SyncService or CreateDeckAndCard bumps the version,
+    so a client presenting the current version is known to be up to date
+    without reading Firestore. Versions live in memory only: after a restart
+    or eviction the user gets a fresh version and one full sync. Writes
+    through other processes are not seen, versions expire after
+    LIBRARY_VERSION_TTL so clients fall back to a full sync at least that often.
+    '''
+    def __init__(self, max_users: int = LIBRARY_VERSION_MAX_USERS, ttl: float = LIBRARY_VERSION_TTL):
+        self._versions = LRUCache(max_entries=max_users, ttl=ttl)
+
+    def get(self, user_id: str) -> Optional[str]:
+        return self._versions.get(user_id)
+
+    def bump(self, user_id: str) -> str:
+        version = uuid.uuid4().hex
+        self._versions.set(user_id, version)
+        return version
+
+    def current(self, user_id: str) -> str:
+        '''
+        Version to hand out with a full response, assigned on first use
+        '''
+        return self.get(user_id) or self.bump(user_id)
+
+    def is_current(self, user_id: str, version: Optional[str]) -> bool:
+        return bool(version) and version == self.get(user_id)
+
+    def stats(self) -> dict:
+        stats = self._versions.stats.to_dict()
+        stats["users"] = len(self._versions)
+        return stats
+
+
+library_versions = LibraryVersions()
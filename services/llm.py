@@ -1,11 +1,24 @@
-import openai
 import os
+import hashlib
 import json
 import time
+import heapq
+import itertools
 import logging
+from collections import deque
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from chunking import estimate_tokens
+from services.cache import create_cache
+from services.json_stream import JsonArrayStreamParser
+from services.llm_client import LLMClient, LLMClientError
+from services.rate_limiter import parse_retry_after, rate_limiter
+from services.resilience import CircuitBreaker, LatencyTracker
 
 @dataclass
 class Flashcard:
@@ -25,8 +38,56 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-openai.api_key = os.getenv("OPENROUTER_API_KEY")
-openai.api_base = "https://openrouter.ai/api/v1"
+
+# OpenAI compatible API the completions are sent to, a local stub server can stand in for tests and benchmarks
+LLM_API_BASE = os.getenv("LLM_API_BASE", "https://openrouter.ai/api/v1")
+# Connections kept open to the API, shared by every upload, and how long an idle one is kept
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "64"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "32"))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "60"))
+# Seconds to establish a connection, LLM_TIMEOUT covers the rest of a request
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+
+LLM_MODEL = "google/gemini-2.5-flash-lite"
+# Models tried in order after LLM_MODEL, when it fails or its circuit is open (comma separated)
+LLM_FALLBACK_MODELS = [model.strip() for model in os.getenv("LLM_FALLBACK_MODELS", "").split(",") if model.strip()]
+LLM_MODELS = [LLM_MODEL] + [model for model in LLM_FALLBACK_MODELS if model != LLM_MODEL]
+# Seconds before a request to OpenRouter is abandoned
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+
+# Send a second, hedged request when the first takes longer than this percentile of recent
+# latencies, and use whichever answers first. Needs LLM_HEDGE_MIN_SAMPLES latencies to start
+LLM_HEDGING = os.getenv("LLM_HEDGING", "true").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# Threads running the requests that may be hedged, shared by every upload
+LLM_REQUEST_WORKERS = int(os.getenv("LLM_REQUEST_WORKERS", "32"))
+
+# Maximum number of chunks sent to OpenRouter at the same time for one file
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+# Attempts per request, and the initial delay between them (doubling) without a Retry-After
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_DELAY = float(os.getenv("LLM_RETRY_DELAY", "2"))
+
+# Per-chunk memo of LLM responses, persisted so edited re-uploads only pay for changed chunks
+CHUNK_MEMO_BACKEND = os.getenv("CHUNK_MEMO_BACKEND", "tiered")
+CHUNK_MEMO_MAX_ENTRIES = int(os.getenv("CHUNK_MEMO_MAX_ENTRIES", "20000"))
+
+# Stream completions and parse cards as they arrive instead of waiting for the whole response
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() == "true"
+# PROMPT_TEMPLATE asks for at most this many cards, a streamed response is not read past them
+MAX_FLASHCARDS_PER_CHUNK = 10
+
+# Short chunks are packed into a single request instead of paying the prompt overhead each
+LLM_PACKING = os.getenv("LLM_PACKING", "true").lower() == "true"
+# Chunks up to this many tokens are packed, up to LLM_PACK_MAX_CHUNKS or LLM_PACK_TOKEN_BUDGET per request
+LLM_PACK_CHUNK_TOKENS = int(os.getenv("LLM_PACK_CHUNK_TOKENS", "500"))
+LLM_PACK_MAX_CHUNKS = int(os.getenv("LLM_PACK_MAX_CHUNKS", "8"))
+LLM_PACK_TOKEN_BUDGET = int(os.getenv("LLM_PACK_TOKEN_BUDGET", "2000"))
+
+# Bump whenever PROMPT_TEMPLATE or PACKED_PROMPT_TEMPLATE changes so cached flashcards are regenerated
+PROMPT_VERSION = "1"
 
 PROMPT_TEMPLATE = """
 Generate flashcards from this text. Return a JSON list with 'front' and 'back' keys. Return a max of only 10 flashcards.
@@ -41,10 +102,104 @@ Return only the JSON list, like:
 ]
 """
 
+PACKED_PROMPT_TEMPLATE = """
+Generate flashcards from each of the texts below. For every text return a list with 'front' and 'back' keys. Return a max of only 10 flashcards per text.
+
+{chunks}
+
+Return only a JSON object with every text id as a key, like:
+{{
+  "0": [{{"front": "...", "back": "..."}}, ...],
+  "1": [...]
+}}
+"""
+
 class OpenRouterError(Exception):
     """Custom exception for OpenRouter API errors"""
     pass
 
+class RetryableError(OpenRouterError):
+    """A failed attempt that may be retried, after retry_after seconds when OpenRouter said so"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RateLimitedError(RetryableError):
+    """OpenRouter answered 429, trying another model would not help"""
+    pass
+
+class FallbackPendingError(RetryableError):
+    """
+    A model failed and the next model is to be tried, but no rate limiter token is free for it
+    Retry with start_model=model once one is, the failure is not the chunk's fault
+    """
+    def __init__(self, message, model, retry_after=None):
+        super().__init__(message, retry_after)
+        self.model = model
+
+class CircuitOpenError(OpenRouterError):
+    """Every model's circuit is open, requests fail fast until a health check passes"""
+    pass
+
+_chunk_memo = create_cache(
+    "chunk_flashcards",
+    backend=CHUNK_MEMO_BACKEND,
+    max_entries=1024,
+    max_disk_entries=CHUNK_MEMO_MAX_ENTRIES
+)
+
+def chunk_memo_key(chunk: str, prompt_template: str = PROMPT_TEMPLATE) -> str:
+    """
+    Hash of the whitespace normalized chunk, the prompt template that produced the cards and the model
+    Only cards of LLM_MODEL are memoized, those of a fallback model are not kept
+    """
+    normalized = " ".join(chunk.split())
+    digest = hashlib.sha256()
+    for part in (normalized, prompt_template, LLM_MODEL):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def chunk_memo_stats() -> dict:
+    """Hit and miss counters of the per-chunk memo"""
+    stats = _chunk_memo.stats.to_dict()
+    stats["backend"] = CHUNK_MEMO_BACKEND
+    stats["entries"] = len(_chunk_memo)
+    return stats
+
+class Flashcards(list):
+    """
+    The flashcards of a chunk and the model that generated them, truncated
+    when they were salvaged from a response that broke off
+    """
+    def __init__(self, cards: Iterable[Flashcard] = (), model: str = LLM_MODEL, truncated: bool = False):
+        super().__init__(cards)
+        self.model = model
+        self.truncated = truncated
+
+    @property
+    def cacheable(self) -> bool:
+        """Complete cards of LLM_MODEL, the chunk memo and the flashcard cache keep no others"""
+        return self.model == LLM_MODEL and not self.truncated
+
+@dataclass
+class ChunkResult:
+    """
+    Outcome of generating flashcards for a single chunk, partial while more cards of it are to come
+    A truncated result holds fewer cards than a complete response would have, and a result
+    of a fallback model differs from what LLM_MODEL generates, neither may be cached
+    """
+    index: int
+    flashcards: List[Flashcard]
+    error: Optional[Exception] = None
+    partial: bool = False
+    truncated: bool = False
+    model: str = LLM_MODEL
+
+    @property
+    def cacheable(self) -> bool:
+        return self.model == LLM_MODEL and not self.truncated
+
 def generate_flashcards(chunk, max_retries=3, retry_delay=2) -> List[Flashcard]:
     """
     Generate flashcards with retry logic and comprehensive error handling
@@ -55,96 +210,509 @@ def generate_flashcards(chunk, max_retries=3, retry_delay=2) -> List[Flashcard]:
         retry_delay: Initial delay between retries (increases exponentially)
 
     Returns:
-        List of Flashcard objects or empty list if all attempts fail
+        List of Flashcard objects or empty list if the response had none
     """
-    prompt = PROMPT_TEMPLATE.format(chunk=chunk)
+    return call_with_retries(lambda: generate_flashcards_once(chunk), max_retries, retry_delay)
 
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Attempting to generate flashcards (attempt {attempt + 1}/{max_retries})")
-
-            response = openai.ChatCompletion.create(
-                model="google/gemini-2.5-flash-lite",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.5,
-                timeout=30
-            )
-
-            content = response.choices[0].message.content.strip()
-            if content:
-                content = cleanup_content(content)
-
-            flashcards_data = json.loads(content)
-
-            # Convert dictionaries to Flashcard objects
-            flashcards = [
-                Flashcard(front=card.get("front", ""), back=card.get("back", ""))
-                for card in flashcards_data
-                if isinstance(card, dict) and card.get("front") and card.get("back")
-            ]
-
-            logger.info(f"Successfully generated {len(flashcards)} flashcards")
-            return flashcards
-
-        except openai.error.APIError as e:
-            error_message = str(e)
-            logger.error(f"OpenRouter API Error (attempt {attempt + 1}): {error_message}")
-
-            # Check for specific error types
-            if "502" in error_message or "Bad Gateway" in error_message:
-                logger.warning("502 Bad Gateway detected - OpenRouter infrastructure issue")
-                if attempt < max_retries - 1:
-                    sleep_time = retry_delay * (2 ** attempt)  # Exponential backoff
-                    logger.info(f"Retrying in {sleep_time} seconds...")
-                    time.sleep(sleep_time)
-                    continue
-                else:
-                    logger.error("Max retries reached for 502 error")
-                    raise OpenRouterError("OpenRouter is experiencing infrastructure issues (502 Bad Gateway). Please try again later.")
-
-            elif "429" in error_message or "rate limit" in error_message.lower():
-                logger.warning("Rate limit exceeded")
-                if attempt < max_retries - 1:
-                    sleep_time = retry_delay * (2 ** attempt) + 5  # Longer wait for rate limits
-                    logger.info(f"Rate limited - waiting {sleep_time} seconds...")
-                    time.sleep(sleep_time)
-                    continue
-                else:
-                    raise OpenRouterError("Rate limit exceeded. Please try again later.")
-
-            else:
-                logger.error(f"Unhandled API error: {error_message}")
-                raise OpenRouterError(f"API Error: {error_message}")
-
-        except openai.error.Timeout:
-            logger.warning(f"Request timeout (attempt {attempt + 1})")
-            if attempt < max_retries - 1:
-                sleep_time = retry_delay * (2 ** attempt)
-                logger.info(f"Retrying after timeout in {sleep_time} seconds...")
-                time.sleep(sleep_time)
-                continue
-            else:
-                raise OpenRouterError("Request timed out after multiple attempts")
+def generate_flashcards_once(chunk, on_card: Optional[Callable[[Flashcard], None]] = None,
+                             start_model: Optional[str] = None) -> List[Flashcard]:
+    """
+    A single attempt of generate_flashcards, raises RetryableError when it may be retried
+    on_card is called with every card of a streamed response as soon as it is parsed,
+    start_model is passed on to create_completion.
+    Cards salvaged from a stream that broke off, or generated by a fallback model,
+    are returned but not memoized.
+    """
+    memoized = get_memoized_flashcards(chunk)
+    if memoized is not None:
+        return memoized
 
+    if LLM_STREAMING:
+        flashcards = Flashcards()
+        cards = stream_flashcards(chunk, start_model)
+        try:
+            while True:
+                card = next(cards)
+                flashcards.append(card)
+                if on_card is not None:
+                    on_card(card)
+        except StopIteration as stop:
+            flashcards.model, flashcards.truncated = stop.value
+    else:
+        content, model = request_completion(PROMPT_TEMPLATE.format(chunk=chunk), start_model)
+        try:
+            flashcards = Flashcards(parse_flashcards(json.loads(content)), model=model)
         except json.JSONDecodeError as e:
             logger.error(f"JSON Decode Error: {e}")
 
             # Don't retry JSON errors as they're likely content issues
-            return []
-
-        except Exception as e:
-            logger.error(f"Unexpected error (attempt {attempt + 1}): {str(e)}")
-            if attempt < max_retries - 1:
-                sleep_time = retry_delay * (2 ** attempt)
-                logger.info(f"Retrying after unexpected error in {sleep_time} seconds...")
-                time.sleep(sleep_time)
+            return Flashcards(model=model)
+
+    logger.info(f"Successfully generated {len(flashcards)} flashcards")
+    if flashcards and flashcards.cacheable:
+        _chunk_memo.set(chunk_memo_key(chunk), [card.to_dict() for card in flashcards])
+    return flashcards
+
+def get_memoized_flashcards(chunk, prompt_templates=(PROMPT_TEMPLATE,)) -> Optional[List[Flashcard]]:
+    """
+    Flashcards generated for the same chunk before with one of the prompt templates,
+    tried in order, None if there are none
+    """
+    for prompt_template in prompt_templates:
+        memoized = _chunk_memo.get(chunk_memo_key(chunk, prompt_template))
+        if memoized is not None:
+            logger.info(f"Reusing {len(memoized)} memoized flashcards for chunk")
+            return Flashcards(Flashcard(front=card["front"], back=card["back"]) for card in memoized)
+    return None
+
+def parse_flashcards(flashcards_data) -> List[Flashcard]:
+    """Flashcard objects of a parsed JSON list, skipping incomplete cards"""
+    if not isinstance(flashcards_data, list):
+        return []
+    return [
+        Flashcard(front=card.get("front", ""), back=card.get("back", ""))
+        for card in flashcards_data
+        if isinstance(card, dict) and card.get("front") and card.get("back")
+    ]
+
+def stream_flashcards(chunk, start_model: Optional[str] = None) -> Iterator[Flashcard]:
+    """
+    Yield the flashcards of a chunk as soon as each card is complete in the streamed response
+
+    Reading stops after MAX_FLASHCARDS_PER_CHUNK cards or the end of the
+    JSON list. When the stream breaks off, turns malformed or reports a
+    provider error the cards that were already complete are kept. A
+    response without a single card raises RetryableError, unless it was a
+    valid empty list. The generator returns the model that answered and
+    whether the cards are truncated.
+    """
+    parser = JsonArrayStreamParser()
+    count = 0
+    stream, model = create_completion(PROMPT_TEMPLATE.format(chunk=chunk), stream=True, start_model=start_model)
+    try:
+        for part in stream:
+            choices = part.get("choices") or [{}]
+            content = (choices[0].get("delta") or {}).get("content")
+            if not content:
+                continue
+            for card in parse_flashcards(parser.feed(content)):
+                count += 1
+                yield card
+                if count >= MAX_FLASHCARDS_PER_CHUNK:
+                    return model, False
+            if parser.closed:
+                return model, False
+    except Exception as e:
+        if count:
+            logger.warning(f"Stream broke off after {count} flashcards, keeping them: {str(e)}")
+            return model, True
+        if isinstance(e, LLMClientError):
+            raise classify_api_error(e)
+        raise RetryableError(f"Stream failed before the first flashcard: {str(e)}")
+    finally:
+        stream.close()
+
+    if count:
+        logger.warning(f"Response ended without closing the list, keeping {count} flashcards")
+        return model, True
+    raise RetryableError("No flashcards could be parsed from the response")
+
+def request_completion(prompt, start_model: Optional[str] = None) -> tuple:
+    """
+    Send a prompt to OpenRouter and return the cleaned up response content and the model that answered
+    """
+    response, model = create_completion(prompt, start_model=start_model)
+    choices = response.get("choices") or [{}]
+    content = ((choices[0].get("message") or {}).get("content") or "").strip()
+    if content:
+        content = cleanup_content(content)
+    return content, model
+
+def create_completion(prompt, stream=False, start_model: Optional[str] = None):
+    """
+    Send a prompt to OpenRouter and return the response, an iterator over
+    the response parts when streaming, together with the model that answered
+
+    A single attempt: errors worth retrying raise RetryableError, carrying
+    the Retry-After delay when OpenRouter said so, other errors raise
+    OpenRouterError. Rate limits and successes are reported to the shared
+    rate limiter. Callers take a rate limiter token first.
+
+    LLM_MODELS are tried in order from start_model, skipping models whose
+    circuit is open and moving on when a model fails with a retryable error
+    other than a rate limit. Every model after the first takes its own rate
+    limiter token. It is never waited for: when none is free
+    FallbackPendingError names the model to start from once one is.
+    CircuitOpenError is raised right away when every circuit is open.
+    """
+    models = LLM_MODELS[LLM_MODELS.index(start_model):] if start_model in LLM_MODELS else LLM_MODELS
+    last_error = None
+    for model in models:
+        breaker = _breakers[model]
+        if not breaker.allow_request():
+            continue
+        if last_error is not None:
+            # The caller's token paid for the first model tried
+            token_wait = rate_limiter.reserve()
+            if token_wait > 0:
+                raise FallbackPendingError(str(last_error), model, token_wait)
+        try:
+            response = hedged_request(model, prompt, stream)
+        except RateLimitedError:
+            raise
+        except RetryableError as e:
+            breaker.on_failure()
+            last_error = e
+            continue
+
+        breaker.on_success()
+        rate_limiter.on_success()
+        if model != LLM_MODEL:
+            logger.info(f"Used fallback model {model}")
+        return response, model
+
+    if last_error is None:
+        raise CircuitOpenError("OpenRouter is unavailable, every model's circuit is open. Please try again later.")
+    raise last_error
+
+def send_request(model, prompt, stream=False):
+    """
+    One request to OpenRouter, its latency is recorded for hedging
+    """
+    started = time.monotonic()
+    messages = [{"role": "user", "content": prompt}]
+    try:
+        if stream:
+            response = _client.open_stream(model, messages, timeout=LLM_TIMEOUT, temperature=0.5)
+        else:
+            response = _client.complete(model, messages, timeout=LLM_TIMEOUT, temperature=0.5)
+    except LLMClientError as e:
+        raise classify_api_error(e)
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        raise RetryableError(f"Unexpected error: {str(e)}")
+
+    _latencies[(model, stream)].record(time.monotonic() - started)
+    return response
+
+def hedge_delay(model, stream=False) -> Optional[float]:
+    """Seconds after which a request to model is hedged, None while hedging is off or unprimed"""
+    if not LLM_HEDGING:
+        return None
+    latency = _latencies[(model, stream)].percentile(LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES)
+    if latency is None:
+        return None
+    return max(LLM_HEDGE_MIN_DELAY, latency)
+
+def hedged_request(model, prompt, stream=False):
+    """
+    send_request, plus a second identical request when the first is slower
+    than hedge_delay. Whichever succeeds first is returned and the other is
+    left to finish in the background. A hedge needs a rate limiter token and
+    is skipped when none is free, so hedging never pushes past the rate limit.
+    """
+    delay = hedge_delay(model, stream)
+    if delay is None:
+        return send_request(model, prompt, stream)
+
+    primary = _request_executor.submit(send_request, model, prompt, stream)
+    done, _ = wait([primary], timeout=delay)
+    if done or rate_limiter.reserve() > 0:
+        return primary.result()
+
+    logger.info(f"No response from {model} after {delay:.1f}s, sending a hedged request")
+    hedge = _request_executor.submit(send_request, model, prompt, stream)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response = future.result()
+            except OpenRouterError as e:
+                error = error or e
                 continue
-            else:
+            _latencies[(model, stream)].record_hedge(won=future is hedge)
+            for loser in pending:
+                loser.add_done_callback(close_response)
+            return response
+    _latencies[(model, stream)].record_hedge(won=False)
+    raise error
+
+def close_response(future):
+    """Close the stream of a hedged request that lost the race"""
+    if future.exception() is None and hasattr(future.result(), "close"):
+        future.result().close()
+
+def classify_api_error(error) -> OpenRouterError:
+    """
+    Map an LLMClientError to RetryableError or OpenRouterError using its HTTP status
+    """
+    status = error.http_status
+    retry_after = parse_retry_after(error.headers.get("retry-after"))
+    logger.error(f"OpenRouter API Error (status {status}): {str(error)}")
+
+    if status == 429:
+        rate_limiter.on_throttled(retry_after)
+        return RateLimitedError("Rate limit exceeded. Please try again later.", retry_after)
+    if status == 502:
+        logger.warning("502 Bad Gateway detected - OpenRouter infrastructure issue")
+        return RetryableError(
+            "OpenRouter is experiencing infrastructure issues (502 Bad Gateway). Please try again later.", retry_after
+        )
+    # No status means the request timed out or never connected
+    if status is None or status >= 500 or status == 408:
+        return RetryableError(f"API Error: {str(error)}", retry_after)
+    return OpenRouterError(f"API Error: {str(error)}")
+
+def retry_delay_for(error: RetryableError, attempt: int, retry_delay: float = LLM_RETRY_DELAY) -> float:
+    """
+    Retry-After when OpenRouter sent one, otherwise exponential backoff
+    """
+    if error.retry_after is not None:
+        return error.retry_after
+    return retry_delay * (2 ** attempt)
+
+def call_with_retries(attempt_call, max_retries=LLM_MAX_RETRIES, retry_delay=LLM_RETRY_DELAY):
+    """
+    Run a single attempt function with blocking retries, for callers outside
+    generate_flashcards_concurrently (which schedules its retries instead)
+    """
+    for attempt in range(max_retries):
+        rate_limiter.acquire()
+        try:
+            return attempt_call()
+        except RetryableError as e:
+            if attempt == max_retries - 1:
+                logger.error("All retry attempts exhausted")
                 raise OpenRouterError(f"Failed to generate flashcards after {max_retries} attempts: {str(e)}")
+            sleep_time = retry_delay_for(e, attempt, retry_delay)
+            logger.info(f"Retrying in {sleep_time} seconds...")
+            time.sleep(sleep_time)
+    raise OpenRouterError(f"Failed to generate flashcards after {max_retries} attempts")
 
-    # If we get here, all retries failed
-    logger.error("All retry attempts exhausted")
-    return []
+def generate_flashcards_packed(chunks: List[str], start_model: Optional[str] = None) -> List[Optional[List[Flashcard]]]:
+    """
+    Generate flashcards for several short chunks with a single request
+
+    The chunks are sent tagged with their position and the response is
+    expected as a JSON object keyed by it. Chunks memoized from either
+    prompt are not sent, cards parsed here are memoized under the packed one.
+    Returns the flashcards of every chunk in the given order, None for the
+    chunks missing from the response, or all of them when it cannot be
+    parsed, which are to be sent in a request of their own. The caller's
+    rate limiter token pays for one request, so when a single chunk is not
+    memoized it is sent on its own right away. A single attempt like
+    generate_flashcards_once.
+    """
+    # Single requests are the fallback for packed chunks, so their memo entries count too
+    results = [get_memoized_flashcards(chunk, (PACKED_PROMPT_TEMPLATE, PROMPT_TEMPLATE)) for chunk in chunks]
+    pending = [index for index, result in enumerate(results) if result is None]
+
+    if len(pending) == 1:
+        results[pending[0]] = generate_flashcards_once(chunks[pending[0]], start_model=start_model)
+    elif pending:
+        packed = "\n\n".join(f'<text id="{index}">\n{chunks[index]}\n</text>' for index in pending)
+        try:
+            content, model = request_completion(PACKED_PROMPT_TEMPLATE.format(chunks=packed), start_model)
+            by_id = json.loads(content)
+            if not isinstance(by_id, dict):
+                raise ValueError("Packed response is not a JSON object")
+            for index in pending:
+                if isinstance(by_id.get(str(index)), list):
+                    results[index] = Flashcards(parse_flashcards(by_id[str(index)]), model=model)
+                    if results[index] and results[index].cacheable:
+                        _chunk_memo.set(
+                            chunk_memo_key(chunks[index], PACKED_PROMPT_TEMPLATE),
+                            [card.to_dict() for card in results[index]]
+                        )
+        except (json.JSONDecodeError, ValueError) as e:
+            logger.warning(f"Could not split packed response of {len(pending)} chunks, falling back: {e}")
+
+        missing = [index for index in pending if results[index] is None]
+        if missing:
+            logger.info(f"Falling back to single requests for {len(missing)}/{len(pending)} packed chunks")
+    return results
+
+def should_pack(chunk) -> bool:
+    """Whether a chunk is short enough to share a request with its neighbours"""
+    return LLM_PACKING and estimate_tokens(chunk) <= LLM_PACK_CHUNK_TOKENS
+
+def iter_chunk_batches(chunks: Iterable[str]) -> Iterator[List[tuple]]:
+    """
+    Group (index, chunk) pairs into the batches sent per request
+
+    Consecutive short chunks share a batch until LLM_PACK_MAX_CHUNKS or
+    LLM_PACK_TOKEN_BUDGET is reached, every other chunk is a batch of its own.
+    """
+    batch = []
+    batch_tokens = 0
+    for index, chunk in enumerate(chunks):
+        if not should_pack(chunk):
+            if batch:
+                yield batch
+                batch, batch_tokens = [], 0
+            yield [(index, chunk)]
+            continue
+
+        tokens = estimate_tokens(chunk)
+        if batch and (len(batch) >= LLM_PACK_MAX_CHUNKS or batch_tokens + tokens > LLM_PACK_TOKEN_BUDGET):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append((index, chunk))
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+def generate_batch(batch: List[tuple], on_card: Optional[Callable[[int, Flashcard], None]] = None,
+                   start_model: Optional[str] = None) -> List[Optional[List[Flashcard]]]:
+    """
+    Flashcards of every chunk of a batch, None for packed chunks to be sent on their own
+    on_card(index, card) sees the cards of a single streamed chunk as they are parsed
+    """
+    if len(batch) == 1:
+        index, chunk = batch[0]
+        on_chunk_card = None if on_card is None else lambda card: on_card(index, card)
+        return [generate_flashcards_once(chunk, on_chunk_card, start_model)]
+    return generate_flashcards_packed([chunk for _, chunk in batch], start_model)
+
+def generate_flashcards_concurrently(chunks: Iterable[str], max_workers=None, partial=False) -> Iterator[ChunkResult]:
+    """
+    Generate flashcards for every chunk with at most max_workers requests in flight
+
+    Results are yielded in completion order, use ChunkResult.index to restore
+    the original chunk order. A failing chunk yields a ChunkResult with the
+    error set instead of aborting the remaining chunks.
+
+    chunks may be a lazy generator: it is only read ahead far enough to keep
+    max_workers requests busy, so requests start while later chunks are
+    still being extracted and at most twice max_workers requests are held.
+    Consecutive short chunks are packed into one request, see iter_chunk_batches.
+
+    Requests only start once the shared rate limiter hands out a token, and
+    retries are scheduled here rather than slept on in the worker threads,
+    so workers stay free for other chunks while a retry waits. The same goes
+    for the requests a batch needs beyond its first: a fallback model without
+    a free token and packed chunks missing from the response are queued
+    again, to start with their own token.
+
+    With partial, the cards of a streamed chunk are yielded as soon as they
+    are parsed, as ChunkResults with partial set. The chunk's final result
+    then only holds the cards not yielded yet. Streamed cards are never
+    taken back: a stream only fails, and is retried, before its first card.
+    A stream that breaks off after that ends its chunk with a truncated result.
+    """
+    max_workers = max(1, max_workers or LLM_MAX_CONCURRENCY)
+    batches = iter_chunk_batches(chunks)
+    # (batch, attempt, start_model) waiting for a rate limiter token, and retries waiting for their time
+    ready = deque()
+    scheduled = []
+    sequence = itertools.count()
+    # Cards parsed by the workers, and a future that completes when there are some, to wake the wait below
+    parsed = queue.SimpleQueue()
+    parsed_lock = threading.Lock()
+    parsed_ready = Future()
+    yielded = {}
+
+    def on_card(index, card):
+        parsed.put((index, card))
+        with parsed_lock:
+            if not parsed_ready.done():
+                parsed_ready.set_result(None)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm") as executor:
+        futures = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(futures) + len(ready) + len(scheduled) < max_workers * 2:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                ready.append((batch, 0, None))
+
+            now = time.monotonic()
+            while scheduled and scheduled[0][0] <= now:
+                _, _, batch, attempt = heapq.heappop(scheduled)
+                ready.appendleft((batch, attempt, None))
+
+            token_wait = None
+            while ready and len(futures) < max_workers:
+                token_wait = rate_limiter.reserve()
+                if token_wait > 0:
+                    break
+                batch, attempt, start_model = ready.popleft()
+                future = executor.submit(generate_batch, batch, on_card if partial else None, start_model)
+                futures[future] = (batch, attempt)
+
+            if not futures and not ready and not scheduled:
+                return
+
+            timeouts = [delay for delay in (token_wait, scheduled[0][0] - now if scheduled else None) if delay]
+            timeout = max(0.0, min(timeouts)) if timeouts else None
+            if not futures:
+                time.sleep(timeout or 0)
+                continue
+
+            done, _ = wait(list(futures) + [parsed_ready], timeout=timeout, return_when=FIRST_COMPLETED)
+            if parsed_ready.done():
+                with parsed_lock:
+                    parsed_ready = Future()
+                for index, cards in drain_parsed_cards(parsed).items():
+                    yielded[index] = yielded.get(index, 0) + len(cards)
+                    yield ChunkResult(index=index, flashcards=cards, partial=True)
+            for future in done:
+                if future not in futures:
+                    continue
+                batch, attempt = futures.pop(future)
+                indexes = [index for index, _ in batch]
+                try:
+                    results = future.result()
+                except FallbackPendingError as e:
+                    logger.info(f"Chunks {[index + 1 for index in indexes]} wait for a token to try {e.model}: {str(e)}")
+                    ready.appendleft((batch, attempt, e.model))
+                    continue
+                except RetryableError as e:
+                    if attempt < LLM_MAX_RETRIES - 1:
+                        delay = retry_delay_for(e, attempt)
+                        logger.info(f"Retrying chunks {[index + 1 for index in indexes]} in {delay} seconds: {str(e)}")
+                        heapq.heappush(scheduled, (time.monotonic() + delay, next(sequence), batch, attempt + 1))
+                        continue
+                    error = OpenRouterError(f"Failed to generate flashcards after {LLM_MAX_RETRIES} attempts: {str(e)}")
+                except Exception as e:
+                    error = e
+                else:
+                    # Cards parsed before the future completed may still be queued
+                    for index, cards in drain_parsed_cards(parsed).items():
+                        yielded[index] = yielded.get(index, 0) + len(cards)
+                        yield ChunkResult(index=index, flashcards=cards, partial=True)
+                    for (index, chunk), flashcards in zip(batch, results):
+                        if flashcards is None:
+                            # A packed chunk the response missed, sent again on its own
+                            ready.append(([(index, chunk)], attempt, None))
+                            continue
+                        yield ChunkResult(
+                            index=index,
+                            flashcards=flashcards[yielded.pop(index, 0):],
+                            truncated=getattr(flashcards, "truncated", False),
+                            model=getattr(flashcards, "model", LLM_MODEL)
+                        )
+                    continue
+
+                for index in indexes:
+                    yielded.pop(index, None)
+                    logger.error(f"Chunk {index + 1} failed: {str(error)}")
+                    yield ChunkResult(index=index, flashcards=[], error=error)
+
+def drain_parsed_cards(parsed: queue.SimpleQueue) -> dict:
+    """Cards waiting in the queue, grouped by chunk index"""
+    cards = {}
+    while True:
+        try:
+            index, card = parsed.get_nowait()
+        except queue.Empty:
+            return cards
+        cards.setdefault(index, []).append(card)
 
 def cleanup_content(content):
     """Clean up LLM response content to extract JSON"""
@@ -155,19 +723,44 @@ def cleanup_content(content):
         content = content.removeprefix("```").removesuffix("```").strip()
     return content
 
-def check_openrouter_health():
+def check_openrouter_health(model=LLM_MODEL):
     """
     Quick health check for OpenRouter API
+    Probes the circuit breaker of model, which closes again once this passes
     Returns True if healthy, False otherwise
     """
     try:
-        openai.ChatCompletion.create(
-            model="google/gemini-2.5-flash-lite",
-            messages=[{"role": "user", "content": "Hello"}],
-            max_tokens=5,
-            timeout=10
-        )
+        _client.complete(model, [{"role": "user", "content": "Hello"}], timeout=10, max_tokens=5)
         return True
     except Exception as e:
-        logger.warning(f"OpenRouter health check failed: {e}")
-        return False
\ No newline at end of file
+        logger.warning(f"OpenRouter health check for {model} failed: {e}")
+        return False
+
+def llm_resilience_stats() -> dict:
+    """Circuit breaker state and request latencies of every model"""
+    return {
+        model: {
+            "circuit": _breakers[model].stats(),
+            "latency": _latencies[(model, False)].stats(),
+            "streaming_latency": _latencies[(model, True)].stats()
+        }
+        for model in LLM_MODELS
+    }
+
+def set_llm_client(client: LLMClient):
+    """Send completions through another client, e.g. one pointed at a stub server"""
+    global _client
+    _client = client
+
+_client = LLMClient(
+    LLM_API_BASE,
+    api_key=os.getenv("OPENROUTER_API_KEY"),
+    max_connections=LLM_HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+    keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY,
+    connect_timeout=LLM_CONNECT_TIMEOUT
+)
+# One circuit per model, a health check probes it while it is open
+_breakers = {model: CircuitBreaker(model, probe=lambda model=model: check_openrouter_health(model)) for model in LLM_MODELS}
+_latencies = {(model, stream): LatencyTracker() for model in LLM_MODELS for stream in (False, True)}
+_request_executor = ThreadPoolExecutor(max_workers=LLM_REQUEST_WORKERS, thread_name_prefix="llm-request")
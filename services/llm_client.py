@@ -0,0 +1,222 @@
+import asyncio
+import json
+import logging
+import threading
+from typing import List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class LLMClientError(Exception):
+    '''
+    A failed chat completion request
+    http_status is None when no response arrived (timeouts, connection errors),
+    headers are the response headers with lowercase names
+    '''
+    def __init__(self, message, http_status: Optional[int] = None, headers: Optional[dict] = None):
+        super().__init__(message)
+        self.http_status = http_status
+        self.headers = headers or {}
+
+
+def error_message(body: bytes) -> str:
+    '''
+    The message of an OpenAI style error body, or the body itself
+    '''
+    try:
+        error = json.loads(body).get("error")
+        if isinstance(error, dict) and error.get("message"):
+            return error["message"]
+    except (ValueError, AttributeError):
+        pass
+    return body.decode("utf-8", errors="replace")[:500] or "Empty response"
+
+
+def raise_for_error_payload(payload: dict):
+    '''
+    OpenRouter reports errors of an upstream provider as an error object,
+    sometimes with a 200 status or inside a stream
+    '''
+    error = payload.get("error")
+    if error:
+        status = error.get("code") if isinstance(error, dict) else None
+        message = error.get("message") if isinstance(error, dict) else str(error)
+        raise LLMClientError(message or "Provider error", http_status=status if isinstance(status, int) else None)
+
+
+class ChatStream:
+    '''
+    Events of a streamed chat completion, each the parsed JSON of a server sent event
+    Iterate it from a thread or with async for from any event loop. close() releases
+    the connection back to the pool, also when the stream was not read to the end.
+    '''
+    def __init__(self, client: "LLMClient", response: httpx.Response):
+        self._client = client
+        self._response = response
+        self._lines = response.aiter_lines()
+        self._closed = False
+
+    async def _next(self) -> Optional[dict]:
+        async for line in self._lines:
+            if not line.startswith("data:"):
+                # Blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            raise_for_error_payload(event)
+            return event
+        await self._aclose()
+        return None
+
+    async def _aclose(self):
+        if not self._closed:
+            self._closed = True
+            await self._response.aclose()
+
+    def _wrap_error(self, e: Exception) -> LLMClientError:
+        if isinstance(e, LLMClientError):
+            return e
+        return LLMClientError(f"Stream interrupted: {e}")
+
+    def __iter__(self):
+        while True:
+            try:
+                event = self._client.run(self._next())
+            except Exception as e:
+                self.close()
+                raise self._wrap_error(e)
+            if event is None:
+                return
+            yield event
+
+    async def __aiter__(self):
+        while True:
+            try:
+                event = await self._client.arun(self._next())
+            except Exception as e:
+                await self._client.arun(self._aclose())
+                raise self._wrap_error(e)
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        if not self._closed:
+            self._client.run(self._aclose())
+
+
+class LLMClient:
+    '''
+    OpenAI compatible chat completions over one pooled keep-alive HTTP session
+
+    The async methods are the entry point. All requests run on the client's
+    own event loop thread, so the sync wrappers used from worker threads and
+    async callers on any other loop share the same connection pool. base_url
+    can point at a local stub server in place of OpenRouter.
+    '''
+    def __init__(self, base_url: str, api_key: Optional[str] = None, max_connections: int = 64,
+                 max_keepalive_connections: int = 32, keepalive_expiry: float = 60.0,
+                 connect_timeout: float = 5.0, headers: Optional[dict] = None):
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        headers = dict(headers or {})
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        self._http = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=headers,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry
+            )
+        )
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="llm-client", daemon=True).start()
+            return self._loop
+
+    def run(self, coroutine):
+        '''
+        Run a coroutine on the client's loop and wait for its result, from any thread but that loop
+        '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self._ensure_loop()).result()
+
+    async def arun(self, coroutine):
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self._ensure_loop()))
+
+    async def _send(self, model: str, messages: List[dict], stream: bool, timeout: Optional[float],
+                    params: dict) -> httpx.Response:
+        payload = {"model": model, "messages": messages, **params}
+        if stream:
+            payload["stream"] = True
+        request = self._http.build_request(
+            "POST", "/chat/completions", json=payload,
+            timeout=httpx.Timeout(timeout, connect=self.connect_timeout)
+        )
+        try:
+            response = await self._http.send(request, stream=True)
+        except httpx.TimeoutException as e:
+            raise LLMClientError(f"Request timed out: {e!r}")
+        except httpx.HTTPError as e:
+            raise LLMClientError(f"Connection error: {e!r}")
+
+        if response.status_code >= 400:
+            try:
+                body = await response.aread()
+            finally:
+                await response.aclose()
+            raise LLMClientError(error_message(body), http_status=response.status_code, headers=dict(response.headers))
+        return response
+
+    async def _complete(self, model, messages, timeout, params) -> dict:
+        response = await self._send(model, messages, False, timeout, params)
+        try:
+            body = await response.aread()
+        except httpx.HTTPError as e:
+            raise LLMClientError(f"Response interrupted: {e!r}")
+        finally:
+            await response.aclose()
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise LLMClientError(f"Invalid JSON response: {body[:200]!r}", http_status=502)
+        raise_for_error_payload(payload)
+        return payload
+
+    async def _open_stream(self, model, messages, timeout, params) -> ChatStream:
+        return ChatStream(self, await self._send(model, messages, True, timeout, params))
+
+    async def acomplete(self, model: str, messages: List[dict], timeout: Optional[float] = 30, **params) -> dict:
+        '''
+        The parsed JSON response of a chat completion, raises LLMClientError when it failed
+        '''
+        return await self.arun(self._complete(model, messages, timeout, params))
+
+    async def aopen_stream(self, model: str, messages: List[dict], timeout: Optional[float] = 30,
+                           **params) -> ChatStream:
+        '''
+        A streamed chat completion, returned once the response status arrived
+        timeout applies to every read, so a stalled stream fails instead of a slow one
+        '''
+        return await self.arun(self._open_stream(model, messages, timeout, params))
+
+    def complete(self, model: str, messages: List[dict], timeout: Optional[float] = 30, **params) -> dict:
+        return self.run(self._complete(model, messages, timeout, params))
+
+    def open_stream(self, model: str, messages: List[dict], timeout: Optional[float] = 30, **params) -> ChatStream:
+        return self.run(self._open_stream(model, messages, timeout, params))
+
+    def close(self):
+        if self._loop is not None:
+            self.run(self._http.aclose())
+            self._loop.call_soon_threadsafe(self._loop.stop)
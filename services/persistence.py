@@ -0,0 +1,184 @@
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from services.create_deck_and_card import CreateDeckAndCard
+
+logger = logging.getLogger(__name__)
+
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "100"))
+PERSIST_WORKERS = int(os.getenv("PERSIST_WORKERS", "1"))
+PERSIST_MAX_RETRIES = int(os.getenv("PERSIST_MAX_RETRIES", "3"))
+# How long a request waits for room in a full queue before persisting the deck itself
+PERSIST_SUBMIT_TIMEOUT = float(os.getenv("PERSIST_SUBMIT_TIMEOUT", "2"))
+# How long shutdown waits for queued decks and retries to be written, keep below the platform's kill timeout
+PERSIST_DRAIN_TIMEOUT = float(os.getenv("PERSIST_DRAIN_TIMEOUT", "25"))
+
+
+@dataclass
+class PersistTask:
+    uid: str
+    deck: Optional[dict]
+    cards: List[dict]
+    attempt: int = 0
+
+    @property
+    def deck_key(self) -> Tuple[str, str]:
+        return self.uid, self.deck["id"] if self.deck is not None else self.cards[0]["deckId"]
+
+
+class WriteBehindPersister:
+    '''
+    Persists generated decks and cards in the background
+    Requests hand over the built deck and cards and return right away. A
+    bounded queue applies backpressure: when it stays full for
+    PERSIST_SUBMIT_TIMEOUT the request persists the deck itself. Items that
+    fail are retried with exponential backoff, up to PERSIST_MAX_RETRIES.
+
+    Cards submitted without their deck wait until the deck is written, so no
+    card is left without its deck whatever the order the workers or the
+    retries run in. drain() waits for everything queued at shutdown.
+    '''
+    def __init__(self, db, max_queue_size: int = PERSIST_QUEUE_SIZE, workers: int = PERSIST_WORKERS,
+                 max_retries: int = PERSIST_MAX_RETRIES, retry_delay: float = 1.0):
+        self.db = db
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._threads = []
+        self._counter_lock = threading.Lock()
+        self.counters = {"persisted": 0, "retried": 0, "failed": 0, "inline": 0}
+        # Decks submitted but not written yet, with the card-only tasks waiting for them
+        self._unsaved_decks: Dict[Tuple[str, str], List[PersistTask]] = {}
+        self._decks_lock = threading.Lock()
+        self._scheduled_retries = 0
+
+    def _count(self, name: str, amount: int = 1):
+        with self._counter_lock:
+            self.counters[name] += amount
+
+    def start(self):
+        if self._threads:
+            return
+        with self._decks_lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"persist-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, uid: str, deck: Optional[dict], cards: List[dict]):
+        '''
+        Queue a deck and its cards, deck None only adds cards to an already submitted deck
+        '''
+        task = PersistTask(uid, deck, cards)
+        if deck is None and not cards:
+            return
+        if deck is not None:
+            with self._decks_lock:
+                self._unsaved_decks.setdefault(task.deck_key, [])
+        try:
+            self._queue.put(task, timeout=PERSIST_SUBMIT_TIMEOUT)
+        except queue.Full:
+            logger.warning("Persistence queue is full, persisting in the request")
+            self._count("inline")
+            self._persist(task)
+
+    def _persist(self, task: PersistTask):
+        writer = CreateDeckAndCard(self.db, task.uid)
+        if task.deck is not None:
+            failed = writer.save_deck_and_cards(task.deck, task.cards)
+        else:
+            with self._decks_lock:
+                waiting = self._unsaved_decks.get(task.deck_key)
+                if waiting is not None:
+                    waiting.append(task)
+                    return
+            failed = writer.save_cards(task.cards)
+
+        failed_ids = {failure["id"] for failure in failed}
+        self._count("persisted", len(task.cards) - len(failed_ids & {card["id"] for card in task.cards}))
+        deck_failed = task.deck is not None and task.deck["id"] in failed_ids
+        if task.deck is not None and not deck_failed:
+            self._deck_saved(task.deck_key)
+        if not failed:
+            return
+
+        retry = PersistTask(
+            task.uid,
+            task.deck if deck_failed else None,
+            [card for card in task.cards if card["id"] in failed_ids],
+            task.attempt + 1
+        )
+        if retry.attempt > self.max_retries:
+            logger.error(f"Giving up persisting {len(retry.cards)} cards for user {task.uid}")
+            self._count("failed", len(retry.cards))
+            if deck_failed:
+                self._deck_failed(task.deck_key)
+            return
+
+        self._count("retried")
+        delay = self.retry_delay * (2 ** task.attempt)
+        with self._decks_lock:
+            self._scheduled_retries += 1
+        threading.Timer(delay, self._requeue, args=(retry,)).start()
+
+    def _deck_saved(self, deck_key: Tuple[str, str]):
+        with self._decks_lock:
+            waiting = self._unsaved_decks.pop(deck_key, [])
+        for task in waiting:
+            self._persist(task)
+
+    def _deck_failed(self, deck_key: Tuple[str, str]):
+        with self._decks_lock:
+            waiting = self._unsaved_decks.pop(deck_key, [])
+        lost = sum(len(task.cards) for task in waiting)
+        if lost:
+            logger.error(f"Dropping {lost} cards of deck {deck_key[1]}, the deck could not be saved")
+            self._count("failed", lost)
+
+    def _requeue(self, task: PersistTask):
+        # Retries must not be dropped, so wait for room rather than time out
+        self._queue.put(task)
+        with self._decks_lock:
+            self._scheduled_retries -= 1
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                self._persist(task)
+            except Exception as e:
+                logger.error(f"Unexpected error persisting deck for user {task.uid}: {str(e)}")
+                self._count("failed", len(task.cards))
+                if task.deck is not None:
+                    self._deck_failed(task.deck_key)
+            finally:
+                self._queue.task_done()
+
+    def drain(self, timeout: float = PERSIST_DRAIN_TIMEOUT) -> bool:
+        '''
+        Wait until queued tasks and scheduled retries are written, False when timeout ran out first
+        '''
+        if not self._threads:
+            return self._queue.unfinished_tasks == 0
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks or self._scheduled_retries:
+            if time.monotonic() >= deadline:
+                logger.error(f"Shutting down with {self._queue.qsize()} decks and "
+                             f"{self._scheduled_retries} retries not persisted")
+                return False
+            time.sleep(0.1)
+        return True
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            stats = dict(self.counters)
+        stats["queued"] = self._queue.qsize()
+        return stats
@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Requests per second to OpenRouter, shared by every chunk and user of the process
+LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", "5"))
+LLM_RATE_LIMIT_MIN = float(os.getenv("LLM_RATE_LIMIT_MIN", "0.2"))
+LLM_RATE_LIMIT_MAX = float(os.getenv("LLM_RATE_LIMIT_MAX", "20"))
+# Requests that may start back to back after an idle period
+LLM_RATE_BURST = float(os.getenv("LLM_RATE_BURST", "4"))
+# Rate added per successful request, and the factor applied on a 429
+LLM_RATE_INCREASE = float(os.getenv("LLM_RATE_INCREASE", "0.05"))
+LLM_RATE_DECREASE = float(os.getenv("LLM_RATE_DECREASE", "0.5"))
+
+
+def parse_retry_after(value) -> Optional[float]:
+    '''
+    Seconds to wait from a Retry-After header, given in seconds or as an HTTP date
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    '''
+    Process-wide token bucket whose rate adapts with AIMD
+    Every success raises the rate by LLM_RATE_INCREASE, a 429 multiplies it
+    by LLM_RATE_DECREASE, at most once per congestion window so a burst of
+    429s from requests that were already in flight counts as one. A
+    Retry-After pauses all requests until it has passed.
+
+    reserve() never blocks, so callers that must not sleep can schedule
+    their own wait. acquire() blocks until a request may start.
+    '''
+    def __init__(self, rate: float = LLM_RATE_LIMIT, min_rate: float = LLM_RATE_LIMIT_MIN,
+                 max_rate: float = LLM_RATE_LIMIT_MAX, burst: float = LLM_RATE_BURST,
+                 increase: float = LLM_RATE_INCREASE, decrease: float = LLM_RATE_DECREASE):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.throttled = 0
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        '''
+        Take a token and return 0 if a request may start now, otherwise
+        return the seconds until one may, without taking a token
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            delay = self.reserve()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        '''
+        Record a 429, retry_after pauses every request for that many seconds
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            # Requests sent at the old rate are still coming back, one window is about 1/rate
+            if now - self._last_decrease >= 1 / self.rate:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_decrease = now
+                logger.warning(f"OpenRouter rate limited, lowering request rate to {self.rate:.2f}/s")
+            self._refill(now)
+            self._tokens = 0.0
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "throttled": self.throttled,
+                "blocked_for": round(max(0.0, self._blocked_until - time.monotonic()), 3)
+            }
+
+
+rate_limiter = AdaptiveRateLimiter()
@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Consecutive failures (5xx, timeouts, connection errors) that open a model's circuit
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+# Seconds an open circuit waits before the health check probes the model again, doubling up to the max
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+LLM_BREAKER_MAX_RESET = float(os.getenv("LLM_BREAKER_MAX_RESET", "300"))
+
+# Request latencies kept per model for the hedging percentile
+LATENCY_WINDOW = 200
+
+
+class CircuitBreaker:
+    '''
+    Stops sending requests to a model that keeps failing
+    closed: requests flow. open: requests are refused until the probe, a
+    cheap health check run on a timer, succeeds. While the probe runs the
+    circuit is half_open and still refuses requests, so a struggling model
+    only ever sees the probe. Every failed probe doubles the wait.
+    '''
+    def __init__(self, name: str, probe: Callable[[], bool], failure_threshold: int = LLM_BREAKER_FAILURES,
+                 reset_timeout: float = LLM_BREAKER_RESET, max_reset_timeout: float = LLM_BREAKER_MAX_RESET):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._wait = reset_timeout
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            return self.state == "closed"
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state != "closed" or self.failures < self.failure_threshold:
+                return
+            self.state = "open"
+            self.opened += 1
+            self._wait = self.reset_timeout
+            logger.warning(f"Circuit for {self.name} opened after {self.failures} failures, "
+                           f"probing again in {self._wait:.0f}s")
+            self._schedule_probe()
+
+    def _schedule_probe(self):
+        self._retry_at = time.monotonic() + self._wait
+        timer = threading.Timer(self._wait, self._run_probe)
+        timer.daemon = True
+        timer.start()
+
+    def _run_probe(self):
+        with self._lock:
+            self.state = "half_open"
+        try:
+            healthy = self.probe()
+        except Exception as e:
+            logger.warning(f"Health probe for {self.name} raised: {e}")
+            healthy = False
+
+        with self._lock:
+            if healthy:
+                self.state = "closed"
+                self.failures = 0
+                logger.info(f"Circuit for {self.name} closed, health check passed")
+                return
+            self.state = "open"
+            self._wait = min(self.max_reset_timeout, self._wait * 2)
+            logger.warning(f"Circuit for {self.name} stays open, probing again in {self._wait:.0f}s")
+            self._schedule_probe()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "opened": self.opened,
+                "retry_in": round(max(0.0, self._retry_at - time.monotonic()), 3) if self.state != "closed" else 0.0
+            }
+
+
+class LatencyTracker:
+    '''
+    Recent request latencies of a model, used to pick the hedging delay
+    '''
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def record_hedge(self, won: bool):
+        with self._lock:
+            self.hedged += 1
+            if won:
+                self.hedge_wins += 1
+
+    def percentile(self, fraction: float, min_samples: int = 1) -> Optional[float]:
+        '''
+        Latency below which the given fraction of requests finished, None with fewer than min_samples
+        '''
+        with self._lock:
+            if len(self._latencies) < max(1, min_samples):
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def stats(self) -> dict:
+        p50 = self.percentile(0.5)
+        p95 = self.percentile(0.95)
+        with self._lock:
+            return {
+                "samples": len(self._latencies),
+                "p50": round(p50, 3) if p50 is not None else None,
+                "p95": round(p95, 3) if p95 is not None else None,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins
+            }
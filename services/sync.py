@@ -1,5 +1,32 @@
-from dataclasses import dataclass
-from typing import List, TypedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, TypedDict
+import logging
+import os
+import time
+
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from services.bulk_writer import BulkWriter, WriteItem, summarize_results
+from services.library_cache import library_cache
+from services.library_version import library_versions
+from services.sync_index import ContentHashIndex, card_key, content_hash, deck_key
+
+# Field stamped by the server on every written deck, card and tombstone
+UPDATED_AT_FIELD = "serverUpdatedAt"
+# Lets the delta read find a user's cards with a single collection group query
+OWNER_FIELD = "ownerId"
+# Excluded from content hashes since the server rewrites them on every write
+SERVER_FIELDS = (UPDATED_AT_FIELD, OWNER_FIELD)
+SYNC_TOKEN_VERSION = "v1"
+# New cursors are moved back by this much so writes committed while a sync
+# was reading are returned again on the next sync instead of being missed
+SYNC_CURSOR_OVERLAP_MS = int(os.getenv("SYNC_CURSOR_OVERLAP_MS", "5000"))
+# Number of decks whose cards are read from Firestore at the same time on a full sync
+SYNC_READ_CONCURRENCY = int(os.getenv("SYNC_READ_CONCURRENCY", "8"))
+
+logger = logging.getLogger(__name__)
 
 class Deck(TypedDict, total=False):
     id: str
@@ -12,41 +39,211 @@ class Card(TypedDict, total=False):
 class SyncData:
     decks: List[Deck]
     cards: List[Card]
+    # Ids of deleted decks and {id, deckId} of deleted cards
+    deleted_decks: List[str] = field(default_factory=list)
+    deleted_cards: List[Card] = field(default_factory=list)
+    # Sent by the client: cursor of its last sync, returned: cursor for the next one
+    sync_token: Optional[str] = None
+    # True when only changes since the client's sync_token are returned
+    is_delta: bool = False
+    # Outcome of the client's writes: {"written": n, "skipped": n, "failed": [{kind, id, error}]}
+    write_results: Optional[dict] = None
+    # Sent by the client: version of the library it holds, returned: current version
+    library_version: Optional[str] = None
+    # True when the client's library_version is current and nothing was read
+    not_modified: bool = False
+
+    def has_changes(self) -> bool:
+        return bool(self.decks or self.cards or self.deleted_decks or self.deleted_cards)
+
+def encode_sync_token(timestamp_ms: int) -> str:
+    return f"{SYNC_TOKEN_VERSION}:{timestamp_ms}"
+
+def decode_sync_token(sync_token: Optional[str]) -> Optional[int]:
+    '''
+    Returns the cursor timestamp in ms, None if the token is missing or not understood
+    '''
+    if not sync_token:
+        return None
+    version, _, timestamp = sync_token.partition(":")
+    if version != SYNC_TOKEN_VERSION or not timestamp.isdigit():
+        return None
+    return int(timestamp)
 
 class SyncService:
+    def _decks_ref(self, user_id: str):
+        return self.db.collection("users").document(user_id).collection("decks")
+
+    def _tombstones_ref(self, user_id: str):
+        return self.db.collection("users").document(user_id).collection("tombstones")
+
+    def _get_deck_cards(self, user_id: str, deck_id: str) -> List[Card]:
+        cards = []
+        for card_doc in self._decks_ref(user_id).document(deck_id).collection("cards").stream():
+            card = card_doc.to_dict()
+            card["id"] = card_doc.id
+            card["deckId"] = deck_id
+            cards.append(card)
+        return cards
+
     def _get_all_sync_data(self, user_id: str) -> SyncData:
         """
         Fetch all decks and all cards for the given user and return as SyncData.
+        The cards of each deck are read in parallel rather than one deck after
+        another. A collection group query is not used here because cards
+        written before ownerId was stamped would be missed.
         """
-        decks_ref = self.db.collection("users").document(user_id).collection("decks")
-        decks_snap = decks_ref.stream()
         decks = []
-        cards = []
-        for deck_doc in decks_snap:
+        for deck_doc in self._decks_ref(user_id).stream():
             deck = deck_doc.to_dict()
             deck["id"] = deck_doc.id
             decks.append(deck)
-            # Fetch cards for this deck
-            cards_ref = decks_ref.document(deck_doc.id).collection("cards")
-            cards_snap = cards_ref.stream()
-            for card_doc in cards_snap:
-                card = card_doc.to_dict()
-                card["id"] = card_doc.id
-                card["deckId"] = deck_doc.id
-                cards.append(card)
+
+        cards = []
+        if decks:
+            max_workers = max(1, min(SYNC_READ_CONCURRENCY, len(decks)))
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sync-read") as executor:
+                # map keeps deck order, so cards are stitched back deck by deck
+                for deck_cards in executor.map(lambda deck: self._get_deck_cards(user_id, deck["id"]), decks):
+                    cards.extend(deck_cards)
         return SyncData(decks=decks, cards=cards)
 
+    def _get_library(self, user_id: str, library_version: str) -> SyncData:
+        """
+        Full library from the library cache, read from Firestore and cached on a miss.
+        """
+        cached = library_cache.get(user_id)
+        if cached is not None:
+            decks, cards = cached
+            return SyncData(decks=decks, cards=cards)
+
+        library = self._get_all_sync_data(user_id)
+        library_cache.put(user_id, library.decks, library.cards, library_version)
+        return library
+
+    def _get_changes_since(self, user_id: str, since_ms: int) -> SyncData:
+        """
+        Fetch the decks, cards and tombstones written after since_ms.
+        Requires the collection group index on cards (ownerId, serverUpdatedAt)
+        from firestore.indexes.json. Cards whose deck was deleted or is missing
+        are left out, clients would otherwise keep them as orphans.
+        """
+        changed_after = FieldFilter(UPDATED_AT_FIELD, ">", since_ms)
+
+        decks = []
+        for deck_doc in self._decks_ref(user_id).where(filter=changed_after).stream():
+            deck = deck_doc.to_dict()
+            deck["id"] = deck_doc.id
+            decks.append(deck)
+
+        cards = []
+        cards_query = self.db.collection_group("cards")\
+            .where(filter=FieldFilter(OWNER_FIELD, "==", user_id))\
+            .where(filter=changed_after)
+        for card_doc in cards_query.stream():
+            card = card_doc.to_dict()
+            card["id"] = card_doc.id
+            card["deckId"] = card_doc.reference.parent.parent.id
+            cards.append(card)
+
+        changed_deck_ids = {deck["id"] for deck in decks}
+        other_deck_ids = {card["deckId"] for card in cards} - changed_deck_ids
+        if other_deck_ids:
+            deck_refs = [self._decks_ref(user_id).document(deck_id) for deck_id in other_deck_ids]
+            existing_deck_ids = changed_deck_ids | {
+                snapshot.id for snapshot in self.db.get_all(deck_refs) if snapshot.exists
+            }
+            cards = [card for card in cards if card["deckId"] in existing_deck_ids]
+
+        deleted_decks = []
+        deleted_cards = []
+        for tombstone_doc in self._tombstones_ref(user_id).where(filter=changed_after).stream():
+            tombstone = tombstone_doc.to_dict()
+            if tombstone.get("kind") == "deck":
+                deleted_decks.append(tombstone["id"])
+            else:
+                deleted_cards.append({"id": tombstone["id"], "deckId": tombstone.get("deckId")})
+
+        return SyncData(
+            decks=decks,
+            cards=cards,
+            deleted_decks=deleted_decks,
+            deleted_cards=deleted_cards,
+            is_delta=True
+        )
+
+    def _delete_deck_cards(self, user_id: str, deck_ids: List[str]) -> Dict[str, None]:
+        """
+        Delete the cards of deleted decks, the delta read would find them otherwise.
+        Returns the index keys of the deleted cards, to be removed from the index.
+        """
+        items = []
+        keys = []
+        for deck_id in deck_ids:
+            for card_ref in self._decks_ref(user_id).document(deck_id).collection("cards").list_documents():
+                items.append(WriteItem("deleted_deck_card", card_ref.id, [(card_ref, None)]))
+                keys.append(card_key(deck_id, card_ref.id))
+        if not items:
+            return {}
+
+        results = BulkWriter(self.db).write(items)
+        failed = sum(1 for result in results if not result.success)
+        if failed:
+            # Left for the next deletion of the deck, the delta read filters them out meanwhile
+            logger.warning(f"Could not delete {failed}/{len(items)} cards of deleted decks for user {user_id}")
+        return {key: None for key, result in zip(keys, results) if result.success}
+
     def __init__(self, db):
         self.db = db
 
     def sync_data(self, user_id: str, sync_data: SyncData):
-        batch = self.db.batch()
+        """
+        Write the client's changes and return what the client is missing.
+        Without a valid sync_token the whole library is returned, otherwise
+        only documents and tombstones written since that token. Clients apply
+        the deletions of a delta before its upserts, so a deck deleted and
+        re-created since the last sync ends up present. Writes are split into
+        batches within Firestore's limit and items that fail are reported in
+        write_results so the client can resend them. Decks and cards whose
+        content hash matches the stored index are skipped.
+
+        A client without changes whose library_version is current gets a
+        not_modified response without any Firestore reads.
+        """
+        if not sync_data.has_changes() and library_versions.is_current(user_id, sync_data.library_version):
+            return SyncData(
+                decks=[],
+                cards=[],
+                sync_token=sync_data.sync_token,
+                library_version=sync_data.library_version,
+                not_modified=True
+            )
+
+        now_ms = int(time.time() * 1000)
+        server_fields = {UPDATED_AT_FIELD: now_ms, OWNER_FIELD: user_id}
+        # Only upserts are compared with the index, deletions just remove their keys
+        if sync_data.decks or sync_data.cards:
+            index = ContentHashIndex.load(self.db, user_id)
+        else:
+            index = ContentHashIndex(self.db, user_id, {})
+        items = []
+        # Index change and cache update applied once the item at the same position is written
+        index_updates = []
+        written_documents = []
+        skipped = 0
 
         for deck in sync_data.decks:
             deck_id = deck.get("id")
             if not deck_id:
                 raise ValueError("Deck must have an id")
-            batch.set(self.db.collection("users").document(user_id).collection("decks").document(deck_id), deck)
+            key, digest = deck_key(deck_id), content_hash(deck, SERVER_FIELDS)
+            if index.get(key) == digest:
+                skipped += 1
+                continue
+            document = {**deck, **server_fields}
+            items.append(WriteItem("deck", deck_id, [(self._decks_ref(user_id).document(deck_id), document)]))
+            index_updates.append((key, digest))
+            written_documents.append(("deck", document))
         for card in sync_data.cards:
             deck_id = card.get("deckId")
             card_id = card.get("id")
@@ -54,10 +251,85 @@ class SyncService:
                 raise ValueError("Card must have an id")
             if not deck_id:
                 raise ValueError("Card must have a deckId")
-            batch.set(self.db.collection("users").document(user_id).collection("decks").document(deck_id).collection("cards").document(card_id), card)
+            key, digest = card_key(deck_id, card_id), content_hash(card, SERVER_FIELDS)
+            if index.get(key) == digest:
+                skipped += 1
+                continue
+            document = {**card, **server_fields}
+            items.append(WriteItem("card", card_id, [
+                (self._decks_ref(user_id).document(deck_id).collection("cards").document(card_id), document)
+            ]))
+            index_updates.append((key, digest))
+            written_documents.append(("card", document))
+
+        for deck_id in sync_data.deleted_decks:
+            items.append(WriteItem("deleted_deck", deck_id, [
+                (self._decks_ref(user_id).document(deck_id), None),
+                (self._tombstones_ref(user_id).document(f"deck_{deck_id}"),
+                 {"kind": "deck", "id": deck_id, UPDATED_AT_FIELD: now_ms})
+            ]))
+            index_updates.append((deck_key(deck_id), None))
+            written_documents.append(("deleted_deck", deck_id))
+        for card in sync_data.deleted_cards:
+            card_id = card.get("id")
+            deck_id = card.get("deckId")
+            if not card_id or not deck_id:
+                raise ValueError("Deleted card must have an id and a deckId")
+            items.append(WriteItem("deleted_card", card_id, [
+                (self._decks_ref(user_id).document(deck_id).collection("cards").document(card_id), None),
+                (self._tombstones_ref(user_id).document(f"card_{card_id}"),
+                 {"kind": "card", "id": card_id, "deckId": deck_id, UPDATED_AT_FIELD: now_ms})
+            ]))
+            index_updates.append((card_key(deck_id, card_id), None))
+            written_documents.append(("deleted_card", {"id": card_id, "deckId": deck_id}))
+
+        try:
+            write_results = BulkWriter(self.db).write(items)
+        except Exception:
+            # Some writes may have landed, neither the cached library nor its version can be trusted
+            library_cache.invalidate(user_id)
+            library_versions.bump(user_id)
+            raise
+
+        # Published before the index and cascade steps, so their failure cannot hide stored writes
+        written = {"deck": [], "card": [], "deleted_deck": [], "deleted_card": []}
+        for (kind, document), result in zip(written_documents, write_results):
+            if result.success:
+                written[kind].append(document)
+        if any(result.success for result in write_results):
+            library_versions.bump(user_id)
+            library_cache.apply(
+                user_id,
+                decks=written["deck"],
+                cards=written["card"],
+                deleted_decks=written["deleted_deck"],
+                deleted_cards=written["deleted_card"]
+            )
 
-        batch.commit()
+        deleted_deck_ids = [
+            item.id for item, result in zip(items, write_results) if item.kind == "deleted_deck" and result.success
+        ]
+        index.save({
+            **{key: digest for (key, digest), result in zip(index_updates, write_results) if result.success},
+            **self._delete_deck_cards(user_id, deleted_deck_ids)
+        })
 
-        get_all_sync_data = self._get_all_sync_data(user_id)
+        # Taken before reading so a write racing with the read changes the version
+        library_version = library_versions.current(user_id)
+        read_started_ms = int(time.time() * 1000)
+        since_ms = decode_sync_token(sync_data.sync_token)
+        if since_ms is None:
+            new_sync_data = self._get_library(user_id, library_version)
+        else:
+            try:
+                new_sync_data = self._get_changes_since(user_id, since_ms)
+            except FailedPrecondition as e:
+                # The cards index of firestore.indexes.json is missing or still building
+                logger.error(f"Delta sync unavailable, falling back to a full sync: {e}")
+                new_sync_data = self._get_library(user_id, library_version)
+        new_sync_data.sync_token = encode_sync_token(read_started_ms - SYNC_CURSOR_OVERLAP_MS)
+        new_sync_data.write_results = summarize_results(write_results)
+        new_sync_data.write_results["skipped"] = skipped
+        new_sync_data.library_version = library_version
 
-        return get_all_sync_data
+        return new_sync_data
@@ -0,0 +1,83 @@
+import hashlib
+import json
+from typing import Dict, Optional
+
+from google.cloud import firestore
+
+# The index is spread over this many documents to stay far below Firestore's 1 MiB document limit
+SYNC_INDEX_SHARDS = 16
+# Hex characters of the SHA-256 kept per document
+HASH_LENGTH = 16
+
+
+def content_hash(document: dict, ignored_fields=()) -> str:
+    '''
+    Hash of the canonical JSON form of a document, ignoring server managed fields
+    '''
+    canonical = json.dumps(
+        {key: value for key, value in document.items() if key not in ignored_fields},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:HASH_LENGTH]
+
+
+def deck_key(deck_id: str) -> str:
+    return f"d:{deck_id}"
+
+
+def card_key(deck_id: str, card_id: str) -> str:
+    return f"c:{deck_id}:{card_id}"
+
+
+class ContentHashIndex:
+    '''
+    Compact per-user map of document key -> content hash of what is stored in Firestore
+    Lets sync skip writing documents the client resends unchanged. Stored in
+    users/{uid}/meta/sync_index_<n> and read with a single get_all.
+    '''
+    def __init__(self, db, user_id: str, entries: Dict[str, str]):
+        self.db = db
+        self.user_id = user_id
+        self.entries = entries
+
+    @staticmethod
+    def _shard(key: str) -> int:
+        return int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:4], 16) % SYNC_INDEX_SHARDS
+
+    @staticmethod
+    def _shard_ref(db, user_id: str, shard: int):
+        return db.collection("users").document(user_id).collection("meta").document(f"sync_index_{shard}")
+
+    @classmethod
+    def load(cls, db, user_id: str) -> "ContentHashIndex":
+        refs = [cls._shard_ref(db, user_id, shard) for shard in range(SYNC_INDEX_SHARDS)]
+        entries = {}
+        for snapshot in db.get_all(refs):
+            if snapshot.exists:
+                entries.update((snapshot.to_dict() or {}).get("entries", {}))
+        return cls(db, user_id, entries)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.entries.get(key)
+
+    def save(self, updates: Dict[str, Optional[str]]):
+        '''
+        Merge changed keys into their shards, a None hash removes the key
+        Only the given keys are touched so concurrent syncs do not overwrite each other
+        '''
+        if not updates:
+            return
+        shards = {}
+        for key, value in updates.items():
+            shards.setdefault(self._shard(key), {})[key] = firestore.DELETE_FIELD if value is None else value
+            if value is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = value
+
+        batch = self.db.batch()
+        for shard, shard_entries in shards.items():
+            batch.set(self._shard_ref(self.db, self.user_id, shard), {"entries": shard_entries}, merge=True)
+        batch.commit()
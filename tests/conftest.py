@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Tests import the app modules the way app.py does, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Caches the modules create at import time stay in memory, out of the working tree
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="study-io-tests-"))
+os.environ.setdefault("CHUNK_MEMO_BACKEND", "memory")
+os.environ.setdefault("FLASHCARD_CACHE_BACKEND", "memory")
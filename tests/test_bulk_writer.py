@@ -0,0 +1,90 @@
+import pytest
+from google.api_core.exceptions import InvalidArgument, ServiceUnavailable
+
+from services.bulk_writer import BulkWriter, WriteItem
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append((ref, data))
+
+    def delete(self, ref):
+        self.writes.append((ref, None))
+
+    def commit(self):
+        self.db.commits.append(len(self.writes))
+        error = self.db.fail(self.writes)
+        if error is not None:
+            raise error
+        self.db.written.extend(ref for ref, _ in self.writes)
+
+
+class FakeDB:
+    """Commits batches unless fail(writes) returns the error to raise"""
+    def __init__(self, fail=lambda writes: None):
+        self.fail = fail
+        self.commits = []
+        self.written = []
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def items(count):
+    return [WriteItem("card", f"c{i}", [(f"cards/c{i}", {"front": f"front {i}"})]) for i in range(count)]
+
+
+def writer(db, **kwargs):
+    return BulkWriter(db, batch_limit=8, max_workers=2, retry_delay=0, **kwargs)
+
+
+def test_items_are_written_in_limit_respecting_batches():
+    db = FakeDB()
+    results = writer(db).write(items(20))
+    assert [result.id for result in results] == [f"c{i}" for i in range(20)]
+    assert all(result.success for result in results)
+    assert sorted(db.commits) == [4, 8, 8]
+
+
+def test_a_rejected_document_only_fails_itself():
+    def fail(writes):
+        if any(ref == "cards/c5" for ref, _ in writes):
+            return InvalidArgument("Property front is too long")
+    db = FakeDB(fail)
+
+    results = writer(db).write(items(8))
+    assert [result.id for result in results if not result.success] == ["c5"]
+    assert len(db.written) == 7
+
+
+def test_an_outage_fails_each_batch_whole_after_its_retries():
+    db = FakeDB(lambda writes: ServiceUnavailable("Firestore is unavailable"))
+
+    results = writer(db, max_retries=3).write(items(20))
+    assert not any(result.success for result in results)
+    assert results[0].error == "503 Firestore is unavailable"
+    # Three batches, each committed max_retries times and never split
+    assert sorted(db.commits) == [4] * 3 + [8] * 6
+
+
+def test_a_transient_error_is_retried_whole():
+    attempts = []
+
+    def fail(writes):
+        attempts.append(len(writes))
+        if len(attempts) == 1:
+            return ServiceUnavailable("Firestore is unavailable")
+    db = FakeDB(fail)
+
+    results = writer(db).write(items(8))
+    assert all(result.success for result in results)
+    assert attempts == [8, 8]
+
+
+def test_an_item_with_too_many_writes_is_refused():
+    with pytest.raises(ValueError):
+        writer(FakeDB()).write([WriteItem("deck", "d", [(f"cards/c{i}", {}) for i in range(9)])])
@@ -0,0 +1,12 @@
+from chunking import StructuredChunker
+
+
+def test_heading_is_not_joined_with_the_paragraph_after_it():
+    paragraphs = list(StructuredChunker(100)._paragraphs([["Intro", "a b c. and more text"]]))
+    assert paragraphs == ["Intro", "a b c. and more text"]
+
+
+def test_paragraph_cut_by_a_page_break_is_joined():
+    pages = [["Intro", "text that is cut"], ["off by the page break.", "next one"]]
+    paragraphs = list(StructuredChunker(100)._paragraphs(pages))
+    assert paragraphs == ["Intro", "text that is cut off by the page break.", "next one"]
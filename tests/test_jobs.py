@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from services import jobs
+from services.jobs import JobQueue, JobStatus
+
+
+@pytest.fixture(autouse=True)
+def short_lease(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_LEASE", 0.3)
+
+
+def wait_for_status(queue, job_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id, "user")
+        if job["status"] == status:
+            return job
+        time.sleep(0.05)
+    return queue.get(job_id, "user")
+
+
+def test_a_job_runs_and_records_its_chunks(tmp_path):
+    def handler(payload_path, progress):
+        progress.set_total(1)
+        progress.chunk_done(0, [{"front": "f", "back": "b"}])
+
+    queue = JobQueue(handler, directory=str(tmp_path))
+    job_id = queue.submit("user", "notes.txt", b"text")
+    queue.start()
+    job = wait_for_status(queue, job_id, JobStatus.COMPLETED.value)
+    assert job["status"] == JobStatus.COMPLETED.value
+    assert job["chunks"] == [{"index": 0, "cards": [{"front": "f", "back": "b"}], "error": None}]
+
+
+def test_a_restarted_process_reclaims_the_job_its_predecessor_was_running(tmp_path):
+    ran = threading.Event()
+    previous = JobQueue(lambda payload_path, progress: None, directory=str(tmp_path))
+    job_id = previous.submit("user", "notes.txt", b"text")
+    # The previous process claimed the job and died with its lease still live
+    previous._execute(
+        "UPDATE jobs SET status = ?, owner = ?, lease_until = ? WHERE id = ?",
+        (JobStatus.RUNNING.value, previous.owner, time.time() + jobs.JOB_LEASE, job_id)
+    )
+
+    restarted = JobQueue(lambda payload_path, progress: ran.set(), directory=str(tmp_path))
+    assert restarted.owner != previous.owner
+    restarted.start()
+    assert wait_for_status(restarted, job_id, JobStatus.COMPLETED.value)["status"] == JobStatus.COMPLETED.value
+    assert ran.is_set()
+
+
+def test_a_job_with_a_live_lease_of_another_process_is_left_alone(tmp_path):
+    ran = threading.Event()
+    other = JobQueue(lambda payload_path, progress: None, directory=str(tmp_path))
+    job_id = other.submit("user", "notes.txt", b"text")
+    other._execute(
+        "UPDATE jobs SET status = ?, owner = ?, lease_until = ? WHERE id = ?",
+        (JobStatus.RUNNING.value, other.owner, time.time() + 60, job_id)
+    )
+
+    queue = JobQueue(lambda payload_path, progress: ran.set(), directory=str(tmp_path))
+    queue.start()
+    time.sleep(1)
+    assert not ran.is_set()
+    assert queue.get(job_id, "user")["status"] == JobStatus.RUNNING.value
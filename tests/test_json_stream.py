@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from services.json_stream import JsonArrayStreamParser
+
+
+def feed_in_pieces(text, size):
+    parser = JsonArrayStreamParser()
+    objects = []
+    for start in range(0, len(text), size):
+        objects += parser.feed(text[start:start + size])
+    return parser, objects
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_objects_are_returned_whatever_the_piece_size(size):
+    cards = [{"front": f"front {i}", "back": f"back {i}"} for i in range(5)]
+    parser, objects = feed_in_pieces(json.dumps(cards), size)
+    assert objects == cards
+    assert parser.closed
+    assert parser.errors == 0
+
+
+def test_objects_are_returned_as_soon_as_they_close():
+    parser = JsonArrayStreamParser()
+    assert parser.feed('[{"front": "a", "back": "b"}') == [{"front": "a", "back": "b"}]
+    assert parser.feed(', {"front": "c", ') == []
+    assert parser.feed('"back": "d"}]') == [{"front": "c", "back": "d"}]
+
+
+def test_braces_and_brackets_inside_strings():
+    cards = [{"front": "set {a, b} and list [1, 2]", "back": "}]{["}]
+    parser, objects = feed_in_pieces(json.dumps(cards), 1)
+    assert objects == cards
+    assert parser.closed
+
+
+def test_escaped_quotes_and_backslashes_inside_strings():
+    cards = [
+        {"front": 'He said "}" loudly', "back": "C:\\path\\"},
+        {"front": "\\\"", "back": "tab\tand unicode \u00e9"},
+    ]
+    parser, objects = feed_in_pieces(json.dumps(cards), 2)
+    assert objects == cards
+    assert parser.errors == 0
+
+
+def test_text_before_the_array_is_skipped():
+    parser, objects = feed_in_pieces('```json\n[{"front": "a", "back": "b"}]\n```', 4)
+    assert objects == [{"front": "a", "back": "b"}]
+    assert parser.closed
+
+
+def test_malformed_middle_object_only_loses_itself():
+    text = '[{"front": "a", "back": "b"}, {"front": oops}, {"front": "c", "back": "d"}]'
+    parser, objects = feed_in_pieces(text, 5)
+    assert objects == [{"front": "a", "back": "b"}, {"front": "c", "back": "d"}]
+    assert parser.errors == 1
+    assert parser.closed
+
+
+def test_truncated_tail_keeps_the_complete_objects():
+    parser, objects = feed_in_pieces('[{"front": "a", "back": "b"}, {"front": "trunc', 3)
+    assert objects == [{"front": "a", "back": "b"}]
+    assert not parser.closed
+    assert parser.errors == 0
+
+
+def test_nested_values_stay_inside_their_object():
+    cards = [{"front": "a", "back": "b", "tags": ["x", {"y": [1]}]}]
+    parser, objects = feed_in_pieces(json.dumps(cards), 1)
+    assert objects == cards
+
+
+def test_non_object_items_are_ignored():
+    parser, objects = feed_in_pieces('["text", 1, {"front": "a", "back": "b"}]', 2)
+    assert objects == [{"front": "a", "back": "b"}]
+
+
+def test_nothing_is_read_after_the_array_closes():
+    parser = JsonArrayStreamParser()
+    assert parser.feed('[{"front": "a", "back": "b"}] [{"front": "c", "back": "d"}]') == [{"front": "a", "back": "b"}]
+    assert parser.closed
+    assert parser.feed('{"front": "e", "back": "f"}') == []
+
+
+def test_text_without_an_array_returns_nothing():
+    parser, objects = feed_in_pieces("Sorry, I cannot help with that.", 4)
+    assert objects == []
+    assert not parser.started
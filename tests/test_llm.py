@@ -0,0 +1,328 @@
+import json
+import threading
+import time
+
+import pytest
+
+from services import llm
+from services.cache import LRUCache
+from services.llm_client import LLMClientError
+from services.rate_limiter import AdaptiveRateLimiter
+from services.resilience import CircuitBreaker, LatencyTracker
+
+CARDS = [{"front": f"Question {i}", "back": f"Answer {i}"} for i in range(5)]
+FALLBACK_MODEL = "fallback/model"
+BOTH_PROMPTS = (llm.PROMPT_TEMPLATE, llm.PACKED_PROMPT_TEMPLATE)
+
+
+class FakeStream:
+    """Streamed completion of the given content pieces, raising error once they are read"""
+    def __init__(self, pieces, error=None):
+        self.pieces = pieces
+        self.error = error
+        self.closed = False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            yield {"choices": [{"delta": {"content": piece}}]}
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+class SlowStream(FakeStream):
+    """FakeStream that waits before every piece, like a model generating"""
+    def __init__(self, pieces, delay):
+        super().__init__(pieces)
+        self.delay = delay
+
+    def __iter__(self):
+        for event in super().__iter__():
+            time.sleep(self.delay)
+            yield event
+
+
+class CountingRateLimiter(AdaptiveRateLimiter):
+    """Counts the tokens handed out"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.granted = 0
+
+    def reserve(self):
+        delay = super().reserve()
+        if delay <= 0:
+            self.granted += 1
+        return delay
+
+
+class FakeClient:
+    """
+    Stands in for LLMClient, respond(model, prompt, stream) returns the
+    content, a FakeStream or raises, every request is recorded
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self.times = []
+        self.lock = threading.Lock()
+
+    def complete(self, model, messages, timeout=None, **params):
+        content = self.request(model, messages, False)
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+    def open_stream(self, model, messages, timeout=None, **params):
+        return self.request(model, messages, True)
+
+    def request(self, model, messages, stream):
+        with self.lock:
+            self.requests.append((model, messages[0]["content"], stream))
+            self.times.append(time.monotonic())
+        return self.respond(model, messages[0]["content"], stream)
+
+
+@pytest.fixture(autouse=True)
+def fresh_llm_state(monkeypatch):
+    monkeypatch.setattr(llm, "LLM_STREAMING", True)
+    monkeypatch.setattr(llm, "LLM_PACKING", False)
+    monkeypatch.setattr(llm, "LLM_HEDGING", False)
+    monkeypatch.setattr(llm, "LLM_MODELS", [llm.LLM_MODEL, FALLBACK_MODEL])
+    monkeypatch.setattr(llm, "_chunk_memo", LRUCache())
+    monkeypatch.setattr(llm, "rate_limiter", AdaptiveRateLimiter(rate=1000, burst=1000))
+    monkeypatch.setattr(llm, "_breakers", {
+        model: CircuitBreaker(model, probe=lambda: True, failure_threshold=100) for model in llm.LLM_MODELS
+    })
+    monkeypatch.setattr(llm, "_latencies", {
+        (model, stream): LatencyTracker() for model in llm.LLM_MODELS for stream in (False, True)
+    })
+
+
+@pytest.fixture
+def use_client(monkeypatch):
+    def install(respond):
+        client = FakeClient(respond)
+        monkeypatch.setattr(llm, "_client", client)
+        return client
+    return install
+
+
+def streamed(content, size=20):
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+def test_a_complete_stream_is_memoized(use_client):
+    client = use_client(lambda model, prompt, stream: FakeStream(streamed(json.dumps(CARDS))))
+    cards = llm.generate_flashcards_once("Some chunk")
+    assert [card.to_dict() for card in cards] == CARDS
+    assert not cards.truncated
+    assert [card.to_dict() for card in llm.generate_flashcards_once("Some chunk")] == CARDS
+    assert len(client.requests) == 1
+
+
+@pytest.mark.parametrize("error", [
+    LLMClientError("Connection reset by peer"),
+    LLMClientError("Upstream failed", http_status=502),
+    None
+])
+def test_cards_of_a_stream_that_broke_off_are_kept_but_not_memoized(use_client, error):
+    # Two complete cards, then the connection drops, the provider fails or the list is never closed
+    content = json.dumps(CARDS)
+    cut = content.index("Question 2") - len('{"front": "')
+    client = use_client(lambda model, prompt, stream: FakeStream(streamed(content[:cut]), error))
+
+    cards = llm.generate_flashcards_once("Some chunk")
+    assert [card.to_dict() for card in cards] == CARDS[:2]
+    assert cards.truncated
+    assert llm.get_memoized_flashcards("Some chunk") is None
+
+    results = list(llm.generate_flashcards_concurrently(["Some chunk"]))
+    assert [(result.index, len(result.flashcards), result.truncated) for result in results] == [(0, 2, True)]
+    assert len(client.requests) == 2
+
+
+
+def primary_down(respond):
+    def respond_or_fail(model, prompt, stream):
+        if model == llm.LLM_MODEL:
+            raise LLMClientError("Service unavailable", http_status=503)
+        return respond(model, prompt, stream)
+    return respond_or_fail
+
+
+def test_cards_of_a_fallback_model_are_returned_but_not_memoized(use_client):
+    client = use_client(primary_down(lambda model, prompt, stream: FakeStream(streamed(json.dumps(CARDS)))))
+
+    results = list(llm.generate_flashcards_concurrently(["Some chunk"]))
+    assert [(len(result.flashcards), result.model, result.cacheable) for result in results] == [
+        (5, FALLBACK_MODEL, False)
+    ]
+    assert llm.get_memoized_flashcards("Some chunk") is None
+    assert [model for model, _, _ in client.requests] == [llm.LLM_MODEL, FALLBACK_MODEL]
+
+
+def test_packed_cards_of_a_fallback_model_are_not_memoized(use_client, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_PACKING", True)
+    use_client(primary_down(lambda model, prompt, stream: json.dumps({"0": CARDS[:2], "1": CARDS[2:]})))
+
+    results = sorted(llm.generate_flashcards_concurrently(["First chunk", "Second chunk"]), key=lambda r: r.index)
+    assert [(len(result.flashcards), result.cacheable) for result in results] == [(2, False), (3, False)]
+    assert llm.get_memoized_flashcards("First chunk", BOTH_PROMPTS) is None
+    assert llm.get_memoized_flashcards("Second chunk", BOTH_PROMPTS) is None
+
+
+def test_packed_cards_are_memoized_under_the_packed_prompt(use_client, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_PACKING", True)
+    client = use_client(lambda model, prompt, stream: json.dumps({"0": CARDS[:2], "1": CARDS[2:]}))
+
+    list(llm.generate_flashcards_concurrently(["First chunk", "Second chunk"]))
+    assert llm.get_memoized_flashcards("First chunk") is None
+    assert len(llm.get_memoized_flashcards("First chunk", (llm.PACKED_PROMPT_TEMPLATE,))) == 2
+
+    results = sorted(llm.generate_flashcards_concurrently(["First chunk", "Second chunk"]), key=lambda r: r.index)
+    assert [len(result.flashcards) for result in results] == [2, 3]
+    assert len(client.requests) == 1
+
+
+def test_packing_reuses_cards_memoized_by_a_single_request(use_client, monkeypatch):
+    use_client(lambda model, prompt, stream: FakeStream(streamed(json.dumps(CARDS))))
+    llm.generate_flashcards_once("First chunk")
+
+    monkeypatch.setattr(llm, "LLM_PACKING", True)
+    client = use_client(lambda model, prompt, stream: FakeStream(streamed(json.dumps(CARDS[:1]))))
+    results = sorted(llm.generate_flashcards_concurrently(["First chunk", "Second chunk"]), key=lambda r: r.index)
+    assert [len(result.flashcards) for result in results] == [5, 1]
+    # Only the chunk that was not memoized is sent, as a single request
+    assert [stream for _, _, stream in client.requests] == [True]
+
+
+def chunk_of(prompt):
+    return next(name for name in ("alpha", "beta", "gamma", "delta") if name in prompt)
+
+
+def test_a_retry_waiting_for_retry_after_does_not_hold_a_worker(use_client):
+    # Both models fail alpha's first attempt
+    failures = {"alpha": 2}
+
+    def respond(model, prompt, stream):
+        name = chunk_of(prompt)
+        if failures.get(name):
+            failures[name] -= 1
+            raise LLMClientError("Service unavailable", http_status=503, headers={"retry-after": "0.3"})
+        return FakeStream(streamed(json.dumps(CARDS)))
+    client = use_client(respond)
+
+    results = list(llm.generate_flashcards_concurrently(["alpha chunk", "beta chunk"], max_workers=1))
+    assert [(result.index, len(result.flashcards), result.error) for result in results] == [(1, 5, None), (0, 5, None)]
+    # beta ran on the only worker while alpha waited, alpha's retry honoured the Retry-After
+    assert [chunk_of(prompt) for _, prompt, _ in client.requests] == ["alpha", "alpha", "beta", "alpha"]
+    assert client.times[3] - client.times[0] >= 0.3
+
+
+def test_a_rate_limit_pauses_every_request_for_its_retry_after(use_client):
+    failures = [1]
+
+    def respond(model, prompt, stream):
+        if failures[0]:
+            failures[0] -= 1
+            raise LLMClientError("Rate limited", http_status=429, headers={"retry-after": "0.3"})
+        return FakeStream(streamed(json.dumps(CARDS)))
+    client = use_client(respond)
+
+    results = list(llm.generate_flashcards_concurrently(["alpha chunk", "beta chunk"], max_workers=1))
+    assert sorted(len(result.flashcards) for result in results) == [5, 5]
+    # A 429 is not retried on the fallback model, and nothing is sent until the Retry-After passed
+    assert {model for model, _, _ in client.requests} == {llm.LLM_MODEL}
+    assert sorted(chunk_of(prompt) for _, prompt, _ in client.requests[1:]) == ["alpha", "beta"]
+    assert client.times[1] - client.times[0] >= 0.3
+
+
+def test_a_chunk_fails_alone_once_its_retries_are_exhausted(use_client, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_MAX_RETRIES", 3)
+
+    def respond(model, prompt, stream):
+        if "alpha" in prompt:
+            raise LLMClientError("Service unavailable", http_status=503, headers={"retry-after": "0"})
+        return FakeStream(streamed(json.dumps(CARDS)))
+    client = use_client(respond)
+
+    results = sorted(llm.generate_flashcards_concurrently(["alpha chunk", "beta chunk"]), key=lambda r: r.index)
+    assert isinstance(results[0].error, llm.OpenRouterError)
+    assert "after 3 attempts" in str(results[0].error)
+    assert (len(results[1].flashcards), results[1].error) == (5, None)
+    # Every attempt tries the primary and the fallback model
+    assert len([prompt for _, prompt, _ in client.requests if "alpha" in prompt]) == 6
+
+
+def test_every_request_takes_a_rate_limiter_token(use_client, monkeypatch):
+    limiter = CountingRateLimiter(rate=1000, burst=1000)
+    monkeypatch.setattr(llm, "rate_limiter", limiter)
+    monkeypatch.setattr(llm, "LLM_PACKING", True)
+
+    def respond(model, prompt, stream):
+        if model == llm.LLM_MODEL and "alpha" in prompt:
+            raise LLMClientError("Service unavailable", http_status=503)
+        if stream:
+            return FakeStream(streamed(json.dumps(CARDS)))
+        # The packed answer misses a chunk, which falls back to a single request
+        return json.dumps({"0": CARDS[:1], "1": CARDS[1:2]})
+    client = use_client(respond)
+
+    chunks = ["beta chunk", "gamma chunk", "delta chunk", "alpha " + "long chunk " * 300]
+    results = list(llm.generate_flashcards_concurrently(chunks))
+    assert sorted(len(result.flashcards) for result in results) == [1, 1, 5, 5]
+    # The packed request, the single request of the chunk it missed, alpha on both models
+    assert len(client.requests) == 4
+    assert limiter.granted == len(client.requests)
+
+
+def test_a_fallback_without_a_free_token_is_rescheduled_instead_of_waited_for(use_client, monkeypatch):
+    limiter = CountingRateLimiter(rate=5, burst=1)
+    monkeypatch.setattr(llm, "rate_limiter", limiter)
+    waits = []
+    monkeypatch.setattr(limiter, "acquire", lambda: waits.append(threading.current_thread().name))
+
+    def respond(model, prompt, stream):
+        if model == llm.LLM_MODEL:
+            raise LLMClientError("Service unavailable", http_status=503)
+        return FakeStream(streamed(json.dumps(CARDS)))
+    client = use_client(respond)
+
+    results = list(llm.generate_flashcards_concurrently(["alpha chunk"]))
+    assert [(len(result.flashcards), result.model) for result in results] == [(5, FALLBACK_MODEL)]
+    assert waits == []
+    # No token was free for the fallback, it was sent on its own once one was
+    assert [model for model, _, _ in client.requests] == [llm.LLM_MODEL, FALLBACK_MODEL]
+    assert client.times[1] - client.times[0] >= 0.1
+    assert limiter.granted == len(client.requests)
+
+
+def test_partial_results_arrive_while_the_chunk_streams(use_client):
+    use_client(lambda model, prompt, stream: SlowStream(streamed(json.dumps(CARDS), size=10), 0.02))
+
+    arrivals = []
+    started = time.monotonic()
+    for result in llm.generate_flashcards_concurrently(["alpha chunk"], partial=True):
+        arrivals.append((time.monotonic() - started, result.partial, len(result.flashcards)))
+
+    assert sum(count for _, _, count in arrivals) == 5
+    assert [partial for _, partial, _ in arrivals[:-1]] == [True] * (len(arrivals) - 1)
+    assert arrivals[-1][1] is False
+    # The first card was handed out well before the stream finished
+    assert len(arrivals) > 2
+    assert arrivals[0][0] < arrivals[-1][0] - 0.1
+
+
+def test_cards_of_a_stream_that_fails_before_its_first_card_are_not_yielded_twice(use_client, monkeypatch):
+    failures = [1]
+
+    def respond(model, prompt, stream):
+        if failures[0]:
+            failures[0] -= 1
+            return FakeStream([], LLMClientError("Connection reset by peer", headers={"retry-after": "0"}))
+        return FakeStream(streamed(json.dumps(CARDS)))
+    use_client(respond)
+
+    results = list(llm.generate_flashcards_concurrently(["alpha chunk"], partial=True))
+    assert sum(len(result.flashcards) for result in results) == 5
+    assert not any(result.error for result in results)
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+os.environ.setdefault("BENCH_LLM_LATENCY", "0")
+
+from benchmark_llm import STUB_CARDS, StubHandler
+from services.llm_client import LLMClient, LLMClientError
+
+MESSAGES = [{"role": "user", "content": "cards please"}]
+
+
+class ErrorStubHandler(StubHandler):
+    """The benchmark stub, with /rate-limited and /provider-error answering like a failing OpenRouter"""
+
+    def do_POST(self):
+        if self.path.startswith("/rate-limited"):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_json(429, {"error": {"message": "Slow down", "code": 429}}, {"Retry-After": "3"})
+        elif self.path.startswith("/provider-error"):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_json(200, {"error": {"message": "Upstream failed", "code": 502}})
+        else:
+            super().do_POST()
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="module")
+def stub_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ErrorStubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(stub_url):
+    client = LLMClient(f"{stub_url}/api/v1", api_key="stub")
+    yield client
+    client.close()
+
+
+def stream_content(events):
+    return "".join(event["choices"][0]["delta"].get("content", "") for event in events)
+
+
+def test_complete(client):
+    response = client.complete("stub-model", MESSAGES)
+    assert response["choices"][0]["message"]["content"] == STUB_CARDS
+
+
+def test_open_stream(client):
+    stream = client.open_stream("stub-model", MESSAGES)
+    assert stream_content(stream) == STUB_CARDS
+
+
+def test_acomplete(client):
+    response = asyncio.run(client.acomplete("stub-model", MESSAGES))
+    assert response["choices"][0]["message"]["content"] == STUB_CARDS
+
+
+def test_aopen_stream(client):
+    async def read():
+        stream = await client.aopen_stream("stub-model", MESSAGES)
+        return [event async for event in stream]
+
+    assert stream_content(asyncio.run(read())) == STUB_CARDS
+
+
+def test_async_requests_share_the_pool_concurrently(client):
+    async def read_all():
+        return await asyncio.gather(*(client.acomplete("stub-model", MESSAGES) for _ in range(8)))
+
+    responses = asyncio.run(read_all())
+    assert [r["choices"][0]["message"]["content"] for r in responses] == [STUB_CARDS] * 8
+
+
+def test_a_stream_closed_early_releases_its_connection(client):
+    stream = client.open_stream("stub-model", MESSAGES)
+    next(iter(stream))
+    stream.close()
+    assert client.complete("stub-model", MESSAGES)["choices"][0]["message"]["content"] == STUB_CARDS
+
+
+def test_error_status_keeps_status_and_headers(stub_url):
+    client = LLMClient(f"{stub_url}/rate-limited")
+    try:
+        with pytest.raises(LLMClientError) as error:
+            asyncio.run(client.acomplete("stub-model", MESSAGES))
+    finally:
+        client.close()
+    assert error.value.http_status == 429
+    assert error.value.headers["retry-after"] == "3"
+    assert str(error.value) == "Slow down"
+
+
+def test_error_payload_with_ok_status_raises(stub_url):
+    client = LLMClient(f"{stub_url}/provider-error")
+    try:
+        with pytest.raises(LLMClientError) as error:
+            client.complete("stub-model", MESSAGES)
+    finally:
+        client.close()
+    assert error.value.http_status == 502
+    assert str(error.value) == "Upstream failed"
+
+
+def test_set_llm_client_routes_requests(client):
+    from services import llm
+
+    previous = llm._client
+    llm.set_llm_client(client)
+    try:
+        response = llm.send_request(llm.LLM_MODEL, "cards please")
+        cards = list(llm.send_request(llm.LLM_MODEL, "cards please", stream=True))
+    finally:
+        llm.set_llm_client(previous)
+    assert response["choices"][0]["message"]["content"] == STUB_CARDS
+    assert stream_content(cards) == STUB_CARDS
@@ -0,0 +1,149 @@
+import threading
+
+from google.api_core.exceptions import InvalidArgument
+
+from services.persistence import WriteBehindPersister
+
+
+class FakeRef:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+
+    def collection(self, name):
+        return FakeRef(self.db, self.path + (name,))
+
+    def document(self, document_id):
+        return FakeRef(self.db, self.path + (document_id,))
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append((ref.path, data))
+
+    def delete(self, ref):
+        self.writes.append((ref.path, None))
+
+    def commit(self):
+        self.db.commit(self.writes)
+
+
+class FakeDB:
+    '''
+    Firestore stand-in that keeps documents by path
+    deck_failures: deck id -> number of times writing it fails, -1 for always
+    Records every card written before its deck
+    '''
+    def __init__(self, deck_failures=None):
+        self.deck_failures = dict(deck_failures or {})
+        self.documents = {}
+        self.orphans = []
+        self.release = threading.Event()
+        self.release.set()
+        self._lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeRef(self, (name,))
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def commit(self, writes):
+        self.release.wait()
+        with self._lock:
+            for path, _ in writes:
+                if path[2] == "decks" and len(path) == 4 and self.deck_failures.get(path[3], 0):
+                    self.deck_failures[path[3]] -= 1
+                    raise InvalidArgument(f"Deck {path[3]} rejected")
+            for path, data in writes:
+                if len(path) == 6 and path[:4] not in self.documents:
+                    self.orphans.append(path)
+                self.documents[path] = data
+
+    def cards(self, deck_id):
+        return [path[5] for path in self.documents if len(path) == 6 and path[3] == deck_id]
+
+
+def deck(deck_id):
+    return {"id": deck_id, "name": deck_id}
+
+
+def cards(deck_id, start, count):
+    return [{"id": f"{deck_id}-c{i}", "deckId": deck_id, "front": "f", "back": "b"} for i in range(start, start + count)]
+
+
+def persister(db, **kwargs):
+    persister = WriteBehindPersister(db, workers=3, retry_delay=0.01, **kwargs)
+    persister.start()
+    return persister
+
+
+def test_cards_submitted_without_their_deck_are_written_after_it():
+    db = FakeDB({"d": 2})
+    writer = persister(db)
+
+    writer.submit("u", deck("d"), cards("d", 0, 2))
+    for start in range(2, 10, 2):
+        writer.submit("u", None, cards("d", start, 2))
+
+    assert writer.drain(timeout=5)
+    assert sorted(db.cards("d")) == sorted(card["id"] for card in cards("d", 0, 10))
+    assert db.orphans == []
+    assert writer.counters["persisted"] == 10
+    assert writer.counters["failed"] == 0
+    assert writer.counters["retried"] == 2
+
+
+def test_cards_of_a_deck_that_is_given_up_on_are_counted_failed():
+    db = FakeDB({"d": -1})
+    writer = persister(db, max_retries=2)
+
+    writer.submit("u", deck("d"), cards("d", 0, 3))
+    writer.submit("u", None, cards("d", 3, 4))
+    writer.submit("u", deck("e"), cards("e", 0, 2))
+
+    assert writer.drain(timeout=5)
+    assert db.cards("d") == []
+    assert len(db.cards("e")) == 2
+    assert db.orphans == []
+    assert writer.counters["failed"] == 7
+    assert writer.counters["persisted"] == 2
+    assert writer.counters["retried"] == 2
+
+
+def test_cards_of_an_already_written_deck_are_not_held_back():
+    db = FakeDB()
+    writer = persister(db)
+
+    writer.submit("u", deck("d"), cards("d", 0, 1))
+    assert writer.drain(timeout=5)
+    writer.submit("u", None, cards("d", 1, 2))
+
+    assert writer.drain(timeout=5)
+    assert len(db.cards("d")) == 3
+    assert writer.counters["persisted"] == 3
+
+
+def test_drain_waits_for_scheduled_retries():
+    db = FakeDB({"d": 1})
+    writer = WriteBehindPersister(db, workers=1, retry_delay=0.3)
+    writer.start()
+
+    writer.submit("u", deck("d"), cards("d", 0, 2))
+    assert writer.drain(timeout=5)
+    assert len(db.cards("d")) == 2
+
+
+def test_drain_gives_up_after_its_timeout():
+    db = FakeDB()
+    db.release.clear()
+    writer = persister(db)
+
+    writer.submit("u", deck("d"), cards("d", 0, 2))
+    assert not writer.drain(timeout=0.2)
+    db.release.set()
+    assert writer.drain(timeout=5)